@@ -0,0 +1,498 @@
+#!/usr/bin/env python
+"""
+Runs the function against a synthetic fleet of sites and domains, with AWS
+and Lets-Encrypt replaced by in-memory fakes, and reports how long the expiry
+checks and planning take and how much memory they use at each fleet size.
+
+    python benchmark.py --sizes=100,1000,10000
+
+Nothing here talks to AWS or Lets-Encrypt, so it can be run anywhere the
+function's dependencies are installed.
+"""
+from __future__ import print_function
+import argparse
+import copy
+import datetime
+import gc
+import json
+import logging
+import random
+import sys
+import time
+import types
+
+from dateutil.tz import tzutc
+
+import model
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2, fall back to the process' peak RSS
+    tracemalloc = None
+    import resource
+
+BUCKET = 'benchmark-config'
+# Sites per ELB when the sites share load balancers via SNI
+SITES_PER_ELB = 50
+
+
+def fake_config(sites, domains):
+    cfg = types.ModuleType('config')
+    cfg.AWS_REGION = 'us-east-1'
+    cfg.S3CONFIGBUCKET = BUCKET
+    cfg.S3CHALLENGEBUCKET = None
+    cfg.SNS_TOPIC_ARN = None
+    cfg.EMAIL = 'benchmark@example.com'
+    cfg.USERKEY_BITS = 2048
+    cfg.CERT_BITS = 2048
+    cfg.DOMAINS = domains
+    cfg.SITES = sites
+    cfg.SCHEDULE_RULE_NAME = None
+    cfg.METRICS_NAMESPACE = None
+    cfg.TRACE_EXPORTERS = []
+    cfg.DELETE_ORPHANED_CERTS = True
+    return cfg
+
+
+def generate_fleet(num_sites, sans=6, shared=2, sites_per_zone=4, elb_share=0.3, mirrored=0.0, seed=1):
+    """ SITES and DOMAINS for num_sites sites with sans names each. Sites are
+    grouped into zones of sites_per_zone, and shared of each site's names are
+    common to its zone(apex, static hosts...) so certificates overlap the way
+    they do in real fleets. elb_share of the sites are ELB SNI sites, and
+    mirrored of them serve exactly the same names as the site before them. """
+    rnd = random.Random(seed)
+    sites = []
+    domains = {}
+    for i in range(num_sites):
+        zone = 'zone{}.example.com'.format(i // sites_per_zone)
+        if sites and rnd.random() < mirrored:
+            names = list(sites[-1]['DOMAINS'])
+        else:
+            names = ['s{}-{}.{}'.format(i, n, zone) for n in range(sans - shared)]
+            names += ['shared{}.{}'.format(n, zone) for n in range(shared)]
+        for name in names:
+            domains.setdefault(name, {
+                'DOMAIN': name,
+                'VALIDATION_METHODS': ['dns-01'],
+                'ROUTE53_ZONE_ID': 'Z{}'.format(i // sites_per_zone),
+            })
+        if rnd.random() < elb_share:
+            sites.append({
+                'ELB_NAME': 'lb{}'.format(i // SITES_PER_ELB),
+                'ELB_PORT': 443,
+                'ELB_SNI': True,
+                'DOMAINS': names,
+            })
+        else:
+            sites.append({
+                'CLOUDFRONT_ID': 'E{:08d}'.format(i),
+                'DOMAINS': names,
+            })
+    return sites, list(domains.values())
+
+
+class FakeClient(object):
+    """ Counts the calls made to it, anything not implemented is a no-op """
+
+    def __init__(self):
+        self.calls = {}
+
+    def _count(self, operation):
+        self.calls[operation] = self.calls.get(operation, 0) + 1
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def call(**kwargs):
+            self._count(name)
+            return {}
+        return call
+
+
+class FakeIam(FakeClient):
+    PAGE_SIZE = 100
+
+    def __init__(self):
+        FakeClient.__init__(self)
+        self.certs = []
+
+    def add(self, name, expiration, upload_date=None):
+        cert = {
+            'ServerCertificateName': name,
+            'ServerCertificateId': 'ASC' + name.upper().replace('-', '').replace('_', ''),
+            'Arn': 'arn:aws:iam::123456789012:server-certificate/cloudfront/' + name,
+            'Path': '/cloudfront/',
+            'Expiration': expiration,
+            'UploadDate': upload_date or expiration - datetime.timedelta(days=90),
+        }
+        self.certs.append(cert)
+        return cert
+
+    def list_server_certificates(self, PathPrefix='/', Marker=None):
+        self._count('ListServerCertificates')
+        start = int(Marker or 0)
+        page = self.certs[start:start + self.PAGE_SIZE]
+        truncated = start + self.PAGE_SIZE < len(self.certs)
+        ret = {'ServerCertificateMetadataList': page, 'IsTruncated': truncated}
+        if truncated:
+            ret['Marker'] = str(start + self.PAGE_SIZE)
+        return ret
+
+    def upload_server_certificate(self, ServerCertificateName, **kwargs):
+        self._count('UploadServerCertificate')
+        now = datetime.datetime.now(tz=tzutc())
+        cert = self.add(ServerCertificateName, now + datetime.timedelta(days=90), now)
+        return {'ServerCertificateMetadata': cert}
+
+
+class FakeCloudFront(FakeClient):
+
+    def __init__(self):
+        FakeClient.__init__(self)
+        self.distributions = {}
+
+    def get_distribution_config(self, Id):
+        self._count('GetDistributionConfig')
+        return copy.deepcopy(self.distributions[Id])
+
+    def list_distributions(self, Marker=None):
+        self._count('ListDistributions')
+        return {'DistributionList': {'IsTruncated': False, 'Items': [
+            {'Id': dist_id, 'ViewerCertificate': dist['DistributionConfig']['ViewerCertificate']}
+            for dist_id, dist in self.distributions.items()
+        ]}}
+
+    def update_distribution(self, DistributionConfig, Id, IfMatch):
+        self._count('UpdateDistribution')
+        self.distributions[Id]['DistributionConfig'] = DistributionConfig
+        return {}
+
+
+class FakeElb(FakeClient):
+
+    def __init__(self):
+        FakeClient.__init__(self)
+        self.listener_certs = {}
+
+    def describe_load_balancers(self, Names=None, Marker=None):
+        self._count('DescribeLoadBalancers')
+        if Names is None:
+            Names = sorted(set(arn.split(':')[2] for arn in self.listener_certs))
+        return {'LoadBalancers': [
+            {'LoadBalancerName': name, 'LoadBalancerArn': 'arn:elb:' + name} for name in Names
+        ]}
+
+    def describe_listeners(self, LoadBalancerArn):
+        self._count('DescribeListeners')
+        return {'Listeners': [{
+            'ListenerArn': LoadBalancerArn + ':443',
+            'Port': 443,
+            'Certificates': [{'CertificateArn': 'arn:default'}],
+        }]}
+
+    def describe_listener_certificates(self, ListenerArn, Marker=None):
+        self._count('DescribeListenerCertificates')
+        arns = self.listener_certs.get(ListenerArn, [])
+        return {'Certificates': [{'CertificateArn': arn} for arn in arns]}
+
+    def add_listener_certificates(self, ListenerArn, Certificates):
+        self._count('AddListenerCertificates')
+        self.listener_certs.setdefault(ListenerArn, []).extend(c['CertificateArn'] for c in Certificates)
+        return {}
+
+
+class FakeBody(object):
+
+    def __init__(self, data):
+        self.data = data
+
+    def read(self):
+        return self.data
+
+
+class FakeS3Client(FakeClient):
+
+    def __init__(self, objects):
+        FakeClient.__init__(self)
+        self.objects = objects
+        self.etags = {}
+
+    def _error(self, code):
+        import botocore.exceptions
+        return botocore.exceptions.ClientError({'Error': {'Code': code, 'Message': code}}, 'S3')
+
+    def head_bucket(self, Bucket):
+        self._count('HeadBucket')
+        return {}
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None):
+        self._count('GetObject')
+        if Key not in self.objects:
+            raise self._error('NoSuchKey')
+        if IfNoneMatch is not None and IfNoneMatch == self.etags.get(Key):
+            raise self._error('304')
+        return {'Body': FakeBody(self.objects[Key]), 'ETag': self.etags.get(Key, '"0"')}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self._count('PutObject')
+        self.objects[Key] = Body
+        self.etags[Key] = '"{}"'.format(len(self.objects) + self.calls['PutObject'])
+        return {'ETag': self.etags[Key]}
+
+    def delete_object(self, Bucket, Key):
+        self._count('DeleteObject')
+        self.objects.pop(Key, None)
+        return {}
+
+
+class FakeS3Object(object):
+
+    def __init__(self, client, bucket, key):
+        self.client = client
+        self.bucket_name = bucket
+        self.key = key
+
+    def put(self, Body, **kwargs):
+        return self.client.put_object(Bucket=self.bucket_name, Key=self.key, Body=Body, **kwargs)
+
+    def get(self):
+        return self.client.get_object(Bucket=self.bucket_name, Key=self.key)
+
+    def delete(self):
+        return self.client.delete_object(Bucket=self.bucket_name, Key=self.key)
+
+
+class FakeS3Objects(object):
+
+    def __init__(self, client, bucket):
+        self.client = client
+        self.bucket = bucket
+
+    def filter(self, Prefix):
+        self.client._count('ListObjects')
+        return [FakeS3Object(self.client, self.bucket, key)
+                for key in sorted(self.client.objects) if key.startswith(Prefix)]
+
+
+class FakeS3Bucket(object):
+
+    def __init__(self, client, name):
+        self.objects = FakeS3Objects(client, name)
+
+
+class FakeS3Meta(object):
+
+    def __init__(self, client):
+        self.client = client
+
+
+class FakeS3(object):
+    """ Just enough of the boto3 S3 resource for the function """
+
+    def __init__(self):
+        self.meta = FakeS3Meta(FakeS3Client({}))
+
+    def Object(self, bucket, key):
+        return FakeS3Object(self.meta.client, bucket, key)
+
+    def Bucket(self, name):
+        return FakeS3Bucket(self.meta.client, name)
+
+
+class FakeUser(object):
+
+    def __init__(self, keybits=2048):
+        pass
+
+    def create_key(self):
+        pass
+
+    def register(self, email):
+        pass
+
+    def serialize(self):
+        return json.dumps({'key': 'benchmark'})
+
+    @staticmethod
+    def unserialize(data):
+        return FakeUser()
+
+
+class FakeAuthorization(object):
+    # names authorized so far
+    authorized = 0
+
+    def __init__(self, user, domain):
+        self.domain = domain
+
+    def authorize(self):
+        FakeAuthorization.authorized += 1
+        return 'valid'
+
+    def serialize(self):
+        return json.dumps({'domain': self.domain, 'status': 'valid'})
+
+    @staticmethod
+    def unserialize(user, data):
+        return FakeAuthorization(user, json.loads(data)['domain'])
+
+
+class FakeCert(object):
+    # certificates issued so far
+    issued = 0
+
+    @staticmethod
+    def generate_csr(keybits, domains):
+        return 'KEY', 'CSR'
+
+    @staticmethod
+    def get_cert(user, csr):
+        FakeCert.issued += 1
+        return 'CERT', 'CHAIN'
+
+
+def install_fakes(lf, sites, due_fraction, seed=1):
+    """ Replaces the function's AWS clients and ACME classes with fakes, and
+    gives each site a current certificate. due_fraction of them are inside
+    their renewal window. """
+    rnd = random.Random(seed)
+    now = datetime.datetime.now(tz=tzutc())
+    fakes = {
+        'iam': FakeIam(),
+        'cloudfront': FakeCloudFront(),
+        'elb': FakeElb(),
+        'acm': FakeClient(),
+        'acm_cloudfront': FakeClient(),
+        'sns': FakeClient(),
+        'route53': FakeClient(),
+        'lambda_c': FakeClient(),
+        'events': FakeClient(),
+    }
+    s3 = FakeS3()
+    manifest = {'version': 1, 'sites': {}}
+
+    for site in sites:
+        sid = model.Site.from_config(site).id
+        if rnd.random() < due_fraction:
+            days = rnd.randint(12, 19)
+        else:
+            days = rnd.randint(31, 89)
+        cert = fakes['iam'].add(sid + '_20240101_000000', now + datetime.timedelta(days=days))
+        if 'CLOUDFRONT_ID' in site:
+            fakes['cloudfront'].distributions[site['CLOUDFRONT_ID']] = {
+                'ETag': 'E1',
+                'DistributionConfig': {'ViewerCertificate': {
+                    'IAMCertificateId': cert['ServerCertificateId'],
+                    'SSLSupportMethod': 'sni-only',
+                }},
+            }
+        else:
+            listener = 'arn:elb:{}:443'.format(site['ELB_NAME'])
+            fakes['elb'].listener_certs.setdefault(listener, []).append(cert['Arn'])
+            manifest['sites'][sid] = {'elb_cert_arn': cert['Arn']}
+    s3.meta.client.objects[lf.MANIFESTKEY] = json.dumps(manifest).encode('utf-8')
+
+    for name, fake in fakes.items():
+        setattr(lf, name, fake)
+    lf.s3 = s3
+    lf.AcmeUser = FakeUser
+    lf.AcmeAuthorization = FakeAuthorization
+    lf.AcmeCert = FakeCert
+    FakeCert.issued = 0
+    FakeAuthorization.authorized = 0
+    lf.fleet = None
+    lf.zone_resolver = None
+    lf.account_cache['data'] = None
+    lf.account_cache['user'] = None
+    fakes['s3'] = s3.meta.client
+    return fakes
+
+
+def run(lf, num_sites, args):
+    sites, domains = generate_fleet(num_sites, sans=args.sans, shared=args.shared,
+                                    sites_per_zone=args.sites_per_zone, elb_share=args.elb_share,
+                                    mirrored=args.mirrored)
+    lf.cfg.SITES = sites
+    lf.cfg.DOMAINS = domains
+    lf.cfg.SAN_PACKING = args.packing
+
+    # timed without tracemalloc, which slows everything down a lot
+    fakes = install_fakes(lf, sites, args.due)
+    gc.collect()
+    started = time.time()
+    result = lf.lambda_handler({}, None)
+    elapsed = time.time() - started
+    issued = FakeCert.issued
+    authorized = FakeAuthorization.authorized
+
+    # then again from scratch for the memory use
+    if tracemalloc:
+        install_fakes(lf, sites, args.due)
+        gc.collect()
+        tracemalloc.start()
+        lf.lambda_handler({}, None)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    else:
+        # kilobytes on Linux, and for the whole process rather than the run
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    timers = result['metrics']['timers_ms']
+    return {
+        'sites': len(sites),
+        'domains': len(domains),
+        'due': sum(1 for status in result['sites'].values() if status != 'not-due'),
+        'total_ms': int(elapsed * 1000),
+        'plan_ms': timers.get('plan', 0),
+        'expiry_check_ms': timers.get('expiry_check', 0),
+        'authorize_ms': timers.get('authorize', 0),
+        'deploy_ms': timers.get('deploy', 0),
+        'peak_mb': round(peak / (1024.0 * 1024.0), 1),
+        'aws_calls': sum(sum(fake.calls.values()) for fake in fakes.values()),
+        'authorizations': authorized,
+        'certs': issued,
+    }
+
+
+COLUMNS = ('sites', 'domains', 'due', 'total_ms', 'plan_ms', 'expiry_check_ms', 'authorize_ms',
+           'deploy_ms', 'peak_mb', 'aws_calls', 'authorizations', 'certs')
+
+
+def format_results(rows):
+    widths = [max(len(c), *[len(str(row[c])) for row in rows]) for c in COLUMNS]
+    lines = ["  ".join(c.rjust(w) for c, w in zip(COLUMNS, widths))]
+    for row in rows:
+        lines.append("  ".join(str(row[c]).rjust(w) for c, w in zip(COLUMNS, widths)))
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the function against a synthetic fleet")
+    parser.add_argument('--sizes', default='100,1000,10000', help="comma separated numbers of sites")
+    parser.add_argument('--sans', type=int, default=6, help="names on each site's certificate")
+    parser.add_argument('--shared', type=int, default=2, help="of which shared with the other sites in its zone")
+    parser.add_argument('--sites-per-zone', type=int, default=4)
+    parser.add_argument('--elb-share', type=float, default=0.3, help="fraction of ELB(SNI) sites")
+    parser.add_argument('--mirrored', type=float, default=0.0,
+                        help="fraction of sites serving the same names as another site")
+    parser.add_argument('--due', type=float, default=0.05, help="fraction of sites due for renewal")
+    parser.add_argument('--packing', action='store_true', help="pack several sites onto each certificate")
+    parser.add_argument('--json', action='store_true', help="print the results as JSON")
+    args = parser.parse_args()
+
+    # the function reads its settings from a config module, give it ours
+    sys.modules['config'] = fake_config([], [])
+    import lambda_function as lf
+    logging.getLogger("Lambda-LetsEncrypt").setLevel(logging.WARNING)
+
+    rows = [run(lf, int(size), args) for size in args.sizes.split(',')]
+    if args.json:
+        print(json.dumps(rows, indent=4))
+    else:
+        print(format_results(rows))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+from __future__ import print_function
+import json
+import logging
+import threading
+
+try:
+    # For Python 3.0 and later
+    from queue import Queue, Empty
+except ImportError:
+    # Fall back to Python 2's Queue
+    from Queue import Queue, Empty
+
+logger = logging.getLogger("Lambda-LetsEncrypt")
+
+
+class LambdaDispatcher:
+    """ Runs a worker event as an asynchronous invocation of a lambda function,
+    so the worker gets a whole invocation's time of its own. The worker leaves
+    its result under the event's 'result' name and wait(name) fetches it, or
+    returns None once we can't wait any longer. A result that didn't turn up
+    comes back as {'pending': name, 'sites': [...]} for the next invocation to
+    collect. """
+
+    def __init__(self, function_name, lambda_client, wait):
+        self.function_name = function_name
+        self.lambda_client = lambda_client
+        self.wait = wait
+
+    def __call__(self, event):
+        self.lambda_client.invoke(
+            FunctionName=self.function_name,
+            InvocationType='Event',
+            Payload=json.dumps(event)
+        )
+        result = self.wait(event['result'])
+        if result is None:
+            return {'pending': event['result'], 'sites': event['sites']}
+        return result
+
+
+class LocalDispatcher:
+    """ Runs a worker event in-process, for testing without AWS. The handler
+    keeps its run in module globals, so only one event can run at a time
+    (max_concurrency=1) and isolate() wraps each one to keep the caller's. """
+
+    def __init__(self, handler, context=None, isolate=None):
+        self.handler = handler
+        self.context = context
+        self.isolate = isolate
+
+    def __call__(self, event):
+        # round trip through json like a real invocation would
+        event = json.loads(json.dumps(event))
+        if self.isolate is None:
+            return self.handler(event, self.context)
+        with self.isolate():
+            return self.handler(event, self.context)
+
+
+def fan_out(dispatch, events, max_concurrency=10, should_continue=None):
+    """ Runs dispatch(event) for each event with at most max_concurrency in flight.
+    should_continue is checked before starting each event, once it returns False
+    no more events are started. Returns (results, events that weren't started) """
+    work = Queue()
+    for i, event in enumerate(events):
+        work.put((i, event))
+
+    results = {}
+    skipped = []
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                try:
+                    i, event = work.get_nowait()
+                except Empty:
+                    return
+                if should_continue is not None and not should_continue():
+                    skipped.append((i, event))
+                    continue
+            try:
+                results[i] = dispatch(event)
+            except Exception as e:
+                logger.error("Worker for {} failed: {}".format(event, e))
+                results[i] = {'error': str(e)}
+                if isinstance(event, dict) and 'sites' in event:
+                    # so aggregate() can report them failed
+                    results[i]['sites'] = event['sites']
+
+    threads = [threading.Thread(target=worker) for _ in range(min(max_concurrency, len(events)))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+
+    return ([results[i] for i in sorted(results)],
+            [event for i, event in sorted(skipped, key=lambda x: x[0])])
+
+
+def aggregate(reports):
+    """ Merges the reports returned by lambda_handler workers into one """
+    sites = {}
+    errors = []
+    notifications = []
+    pending = []
+    for report in reports:
+        if not isinstance(report, dict):
+            continue
+        if 'error' in report:
+            # a worker that failed outright, with the ids of the sites it was given
+            errors.append(report['error'])
+            for site_id in report.get('sites', []):
+                sites[site_id] = 'failed'
+            continue
+        errors.extend(report.get('errors', []))
+        if 'pending' in report:
+            pending.append({'result': report['pending'], 'sites': report['sites']})
+            continue
+        sites.update(report.get('sites', {}))
+        notifications.extend(report.get('notifications', []))
+    counts = {}
+    for status in sites.values():
+        counts[status] = counts.get(status, 0) + 1
+    ret = {'sites': sites, 'counts': counts}
+    if errors:
+        ret['errors'] = errors
+    if notifications:
+        ret['notifications'] = notifications
+    if pending:
+        ret['pending'] = pending
+    return ret
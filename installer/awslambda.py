@@ -1,6 +1,7 @@
 import boto3
+import instrumentation
 from botocore.exceptions import ClientError
-lambda_c = boto3.client('lambda')
+lambda_c = instrumentation.instrument(boto3.client('lambda'))
 
 
 def create_function(name, iam_role, archive_filename, handler='lambda_function.lambda_handler'):
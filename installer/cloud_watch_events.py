@@ -1,6 +1,7 @@
 import boto3
+import instrumentation
 
-ev_client = boto3.client('events')
+ev_client = instrumentation.instrument(boto3.client('events'))
 
 
 def cloudwatch_create_daily_rule_for_function(lambda_function_name, lambda_function_arn, iam_arn):
@@ -25,4 +26,30 @@ def cloudwatch_create_daily_rule_for_function(lambda_function_name, lambda_funct
         ]
     )
 
-    return rule
\ No newline at end of file
+    return rule
+
+
+def cloudwatch_create_daily_rule_for_state_machine(state_machine_name, state_machine_arn, iam_arn):
+
+    rule_name = "daily-event-for-{}".format(state_machine_name)
+
+    rule = ev_client.put_rule(
+        Name=rule_name,
+        ScheduleExpression='rate(1 day)',
+        State='ENABLED',
+        Description='Executed every day',
+        RoleArn=iam_arn
+    )
+
+    ev_client.put_targets(
+        Rule=rule_name,
+        Targets=[
+            {
+                'Id': state_machine_name,
+                'Arn': state_machine_arn,
+                'RoleArn': iam_arn
+            }
+        ]
+    )
+
+    return rule
@@ -1,6 +1,7 @@
 import boto3
+import instrumentation
 from botocore.exceptions import ClientError
-cloudfront_c = boto3.client('cloudfront')
+cloudfront_c = instrumentation.instrument(boto3.client('cloudfront'))
 
 
 def list_distributions():
@@ -1,6 +1,7 @@
 import boto3
+import instrumentation
 
-ec2_client = boto3.client('ec2')
+ec2_client = instrumentation.instrument(boto3.client('ec2'))
 
 
 def list_region_names():
@@ -1,7 +1,8 @@
 import boto3
+import instrumentation
 from botocore.exceptions import ClientError
 
-elb_c = boto3.client('elb')
+elb_c = instrumentation.instrument(boto3.client('elb'))
 
 
 def list_elbs():
@@ -1,9 +1,11 @@
 import boto3
+import instrumentation
 from botocore.exceptions import ClientError
 import json
 
-iam_c = boto3.client('iam')
+iam_c = instrumentation.instrument(boto3.client('iam'))
 iam_r = boto3.resource('iam')
+instrumentation.instrument(iam_r.meta.client)
 
 
 def generate_policy_document(s3buckets=None, snstopicarn=None):
@@ -42,6 +44,13 @@ def get_or_create_role(role_name):
             "Service": "events.amazonaws.com"
           },
           "Action": "sts:AssumeRole"
+        },
+        {
+          "Effect": "Allow",
+          "Principal": {
+            "Service": "states.amazonaws.com"
+          },
+          "Action": "sts:AssumeRole"
         }
       ]
     }"""
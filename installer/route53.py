@@ -1,21 +1,25 @@
 import boto3
+import instrumentation
+import zones
 from botocore.exceptions import ClientError
 
-route53_c = boto3.client('route53')
+route53_c = instrumentation.instrument(boto3.client('route53'))
+
+# listed once, however many domains the wizard looks up
+_zones = None
+_index = None
 
 
 def list_zones():
-    elbs = route53_c.list_hosted_zones()
-    ret = []
-    for x in elbs['HostedZones']:
-        ret.append({
-            'Id': x['Id'],
-            'Name': x['Name'].rstrip('.')  # remove trailing dots
-        })
-    return ret
+    global _zones
+    if _zones is None:
+        _zones = zones.list_zones(route53_c)
+    return _zones
 
 
-def get_zone_id(zone):
-    zone = zone.rstrip(".")  # remove any possible trailing dots
-    zones = list_zones()
-    return next((z['Id'] for z in zones if z['Name'] == zone), None)
+def get_zone_id(name):
+    # the zone the name is in(the longest matching one), not just a zone named name
+    global _index
+    if _index is None:
+        _index = zones.ZoneIndex(list_zones())
+    return _index.lookup(name)
@@ -1,9 +1,11 @@
 import boto3
+import instrumentation
 from botocore.exceptions import ClientError
 import string
 
-s3_c = boto3.client('s3')
+s3_c = instrumentation.instrument(boto3.client('s3'))
 s3_r = boto3.resource('s3')
+instrumentation.instrument(s3_r.meta.client)
 
 WEB_POLICY_DOC = string.Template("""\
 {
@@ -54,3 +56,14 @@ def create_web_bucket(region_name, bucket_name):
         }
     )
     return bucket
+
+
+def list_keys(bucket_name, prefix):
+    ret = []
+    for obj in s3_r.Bucket(bucket_name).objects.filter(Prefix=prefix):
+        ret.append((obj.key, obj.last_modified))
+    return ret
+
+
+def get_object(bucket_name, key):
+    return s3_r.Object(bucket_name, key).get()['Body'].read()
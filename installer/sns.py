@@ -1,11 +1,13 @@
 import boto3
+import instrumentation
 from botocore.exceptions import ClientError
 
 
 def get_or_create_topic(email):
     topicname = "letsencrypt-lambda-notify"
     sns_r = boto3.resource('sns')
-    sns_c = boto3.client('sns')
+    instrumentation.instrument(sns_r.meta.client)
+    sns_c = instrumentation.instrument(boto3.client('sns'))
 
     # If the topic doesn't exist, this will create it, otherwise it returns
     # the existing topic.
@@ -0,0 +1,179 @@
+from __future__ import print_function
+import json
+import time
+import boto3
+import instrumentation
+from botocore.exceptions import ClientError
+
+sfn_c = instrumentation.instrument(boto3.client('stepfunctions'))
+
+
+def _task(function_arn, stage, next_state):
+    return {
+        'Type': 'Task',
+        'Resource': function_arn,
+        'Parameters': {
+            'stage': stage,
+            'state.$': '$'
+        },
+        'Retry': [{
+            'ErrorEquals': ['Lambda.ServiceException', 'Lambda.TooManyRequestsException'],
+            'IntervalSeconds': 5,
+            'MaxAttempts': 3,
+            'BackoffRate': 2.0
+        }],
+        'Next': next_state
+    }
+
+
+def generate_definition(function_arn, wait_seconds=60, max_validation_attempts=30):
+    """ Amazon States Language definition for the issuance pipeline. Waiting
+    on the CA to validate challenges happens in a Wait state, not in Lambda. """
+    return {
+        'Comment': 'Lambda Lets-Encrypt certificate issuance pipeline',
+        'StartAt': 'Plan',
+        'States': {
+            'Plan': _task(function_arn, 'plan', 'HasWork'),
+            'HasWork': {
+                'Type': 'Choice',
+                'Choices': [{
+                    'Variable': '$.has_work',
+                    'BooleanEquals': True,
+                    'Next': 'Authorize'
+                }],
+                'Default': 'Done'
+            },
+            'Authorize': _task(function_arn, 'authorize', 'Validated'),
+            'Validated': {
+                'Type': 'Choice',
+                'Choices': [{
+                    'Variable': '$.ready',
+                    'BooleanEquals': True,
+                    'Next': 'Issue'
+                }, {
+                    # issue whatever is ready, the rest is picked up next time
+                    'Variable': '$.attempts',
+                    'NumericGreaterThanEquals': max_validation_attempts,
+                    'Next': 'Issue'
+                }],
+                'Default': 'WaitForValidation'
+            },
+            'WaitForValidation': {
+                'Type': 'Wait',
+                'Seconds': wait_seconds,
+                'Next': 'AwaitValidation'
+            },
+            'AwaitValidation': _task(function_arn, 'await-validation', 'Validated'),
+            'Issue': _task(function_arn, 'issue', 'Deploy'),
+            'Deploy': _task(function_arn, 'deploy', 'Done'),
+            'Done': {
+                'Type': 'Succeed'
+            }
+        }
+    }
+
+
+def create_or_update_state_machine(name, definition, role_arn):
+    try:
+        existing = [m for m in sfn_c.list_state_machines()['stateMachines'] if m['name'] == name]
+        if existing:
+            sfn_c.update_state_machine(
+                stateMachineArn=existing[0]['stateMachineArn'],
+                definition=json.dumps(definition),
+                roleArn=role_arn
+            )
+            return existing[0]['stateMachineArn']
+        machine = sfn_c.create_state_machine(
+            name=name,
+            definition=json.dumps(definition),
+            roleArn=role_arn
+        )
+    except ClientError as e:
+        print(e)
+        return False
+    return machine['stateMachineArn']
+
+
+def _get_path(data, path):
+    if path == '$':
+        return data
+    for key in path[2:].split('.'):
+        data = data[key]
+    return data
+
+
+def _render_parameters(parameters, data):
+    ret = {}
+    for key, value in parameters.items():
+        if key.endswith('.$'):
+            ret[key[:-2]] = _get_path(data, value)
+        elif isinstance(value, dict):
+            ret[key] = _render_parameters(value, data)
+        else:
+            ret[key] = value
+    return ret
+
+
+CHOICE_OPERATORS = {
+    'BooleanEquals': lambda a, b: a == b,
+    'StringEquals': lambda a, b: a == b,
+    'NumericEquals': lambda a, b: a == b,
+    'NumericLessThan': lambda a, b: a < b,
+    'NumericGreaterThan': lambda a, b: a > b,
+    'NumericGreaterThanEquals': lambda a, b: a >= b,
+    'NumericLessThanEquals': lambda a, b: a <= b,
+}
+
+
+def _choice_matches(rule, data):
+    try:
+        value = _get_path(data, rule['Variable'])
+    except KeyError:
+        return False
+    for op, func in CHOICE_OPERATORS.items():
+        if op in rule:
+            return func(value, rule[op])
+    raise ValueError("Unsupported choice rule: {}".format(rule))
+
+
+class LocalStateMachine:
+    """ Runs a state machine definition in-process, calling handler(event, context)
+    for Task states. Supports the subset of ASL used by generate_definition. """
+
+    def __init__(self, definition, handler, wait=False, max_transitions=1000):
+        self.definition = definition
+        self.handler = handler
+        self.wait = wait
+        self.max_transitions = max_transitions
+        self.history = []
+
+    def run(self, data=None, context=None):
+        data = data or {}
+        name = self.definition['StartAt']
+        for _ in range(self.max_transitions):
+            state = self.definition['States'][name]
+            self.history.append(name)
+            kind = state['Type']
+            if kind == 'Task':
+                event = _render_parameters(state.get('Parameters', {'state.$': '$'}), data)
+                data = self.handler(event, context)
+            elif kind == 'Choice':
+                matched = [c['Next'] for c in state['Choices'] if _choice_matches(c, data)]
+                name = matched[0] if matched else state['Default']
+                continue
+            elif kind == 'Wait':
+                if self.wait:
+                    time.sleep(state['Seconds'])
+            elif kind == 'Pass':
+                data = state.get('Result', data)
+            elif kind == 'Succeed':
+                return data
+            elif kind == 'Fail':
+                raise RuntimeError("State machine failed in '{}': {}".format(name, state.get('Error')))
+            else:
+                raise ValueError("Unsupported state type '{}'".format(kind))
+
+            if state.get('End'):
+                return data
+            name = state['Next']
+        raise RuntimeError("State machine did not finish after {} transitions".format(self.max_transitions))
@@ -0,0 +1,124 @@
+from __future__ import print_function
+import threading
+import time
+
+import retry
+import tracing
+
+# Columns of the per-operation table, and what it can be sorted by
+COLUMNS = ('operation', 'calls', 'total_ms', 'max_ms', 'retries', 'throttled', 'errors', 'bytes')
+
+_lock = threading.Lock()
+_operations = {}
+
+
+def reset():
+    with _lock:
+        _operations.clear()
+
+
+def snapshot():
+    """ The operations recorded so far, for restore() """
+    with _lock:
+        return dict((name, dict(op)) for name, op in _operations.items())
+
+
+def restore(saved):
+    with _lock:
+        _operations.clear()
+        _operations.update(saved)
+
+
+def instrument(client):
+    """ Registers the hooks on a boto3 client(or a retry.RetryingClient), returns
+    the client so it can wrap the boto3.client() call """
+    events = client.meta.events
+    events.register('before-call', _before_call, unique_id='lambda-letsencrypt-before-call')
+    events.register('after-call', _after_call, unique_id='lambda-letsencrypt-after-call')
+    events.register('after-call-error', _after_call_error, unique_id='lambda-letsencrypt-after-call-error')
+    return client
+
+
+def _operation(event_name):
+    # event names look like 'after-call.iam.ListServerCertificates'
+    return event_name.split('.', 1)[-1]
+
+
+def _before_call(event_name=None, context=None, **kwargs):
+    if context is not None:
+        context['lambda_letsencrypt_start'] = time.time()
+        context['lambda_letsencrypt_span'] = tracing.start('aws.' + _operation(event_name))
+
+
+def _after_call(event_name=None, context=None, http_response=None, parsed=None, model=None, **kwargs):
+    parsed = parsed or {}
+    size = 0
+    if http_response is not None:
+        length = http_response.headers.get('content-length')
+        if length is not None:
+            size = int(length)
+        elif model is None or not model.has_streaming_output:
+            # don't read streamed bodies(e.g. S3 objects), the caller does that
+            size = len(http_response.content or b'')
+    _finish(event_name, context, parsed.get('Error', {}).get('Code'),
+            http_response.status_code if http_response is not None else 0, size)
+
+
+def _after_call_error(event_name=None, context=None, exception=None, **kwargs):
+    # the request never got a response(e.g. the connection failed)
+    _finish(event_name, context, type(exception).__name__, 0, 0)
+
+
+def _finish(event_name, context, error, status, size):
+    start = (context or {}).get('lambda_letsencrypt_start')
+    elapsed_ms = (time.time() - start) * 1000 if start else 0
+
+    span = (context or {}).get('lambda_letsencrypt_span')
+    if span is not None:
+        span.set('status', status)
+        span.set('bytes', size)
+        if error:
+            span.set('error', error)
+        span.finish('error' if error else 'ok')
+
+    with _lock:
+        op = _operations.setdefault(_operation(event_name), {
+            'calls': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'retries': 0, 'throttled': 0, 'errors': 0, 'bytes': 0
+        })
+        op['calls'] += 1
+        op['total_ms'] += elapsed_ms
+        op['max_ms'] = max(op['max_ms'], elapsed_ms)
+        # botocore's own retries are off, ours happen in retry.RetryPolicy
+        if retry.retrying():
+            op['retries'] += 1
+        op['bytes'] += size
+        if error:
+            op['errors'] += 1
+            if error in retry.THROTTLING_CODES:
+                op['throttled'] += 1
+
+
+def table(sort_by='total_ms'):
+    """ One row per AWS operation called since the last reset(), largest first """
+    if sort_by not in COLUMNS:
+        raise ValueError("Can't sort by '{}', choose one of {}".format(sort_by, ", ".join(COLUMNS)))
+    with _lock:
+        rows = []
+        for name, op in _operations.items():
+            row = dict(op)
+            row['operation'] = name
+            row['total_ms'] = int(row['total_ms'])
+            row['max_ms'] = int(row['max_ms'])
+            rows.append(row)
+    return sorted(rows, key=lambda row: row[sort_by], reverse=sort_by != 'operation')
+
+
+def format_table(rows):
+    """ The rows from table() as aligned text, for logs and the terminal """
+    lines = [[str(row[c]) for c in COLUMNS] for row in rows]
+    widths = [max([len(c)] + [len(line[i]) for line in lines]) for i, c in enumerate(COLUMNS)]
+    out = []
+    for line in [list(COLUMNS)] + lines:
+        cells = [line[0].ljust(widths[0])] + [cell.rjust(w) for cell, w in zip(line[1:], widths[1:])]
+        out.append("  ".join(cells))
+    return "\n".join(out)
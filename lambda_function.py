@@ -1,22 +1,36 @@
 from __future__ import print_function
 import logging
 import datetime
-from time import strftime, gmtime, sleep
+import json
+import uuid
+from time import strftime, gmtime, time, sleep
+from contextlib import contextmanager
 from dateutil.tz import tzutc
-from simple_acme import AcmeUser, AcmeAuthorization, AcmeCert
+from simple_acme import AcmeUser, AcmeAuthorization, AcmeCert, AcmeError
 from functools import partial
+import dns.exception
 import dns.resolver
-
-try:
-    # For Python 3.0 and later
-    from urllib.request import urlopen
-except ImportError:
-    # Fall back to Python 2's urllib2
-    from urllib2 import urlopen
+import fanout
+import instrumentation
+import manifest
+import metrics
+import model
+import notify
+import packing
+import preflight
+import profiling
+import registry
+import renewal
+import retry
+import scheduling
+import tracing
+import zones
+from timebudget import TimeBudget
 
 # aws imports
 import boto3
 import botocore
+from botocore.config import Config
 
 # Configure logging
 logging.basicConfig(level=logging.ERROR)
@@ -30,38 +44,133 @@ import config as cfg
 # No need to edit beyond this line
 ###############################################################################
 
+# Retries for everything are handled by the policies below(see retry.py)
+# rather than by botocore
+aws_retry = retry.RetryPolicy('aws')
+aws_config = Config(retries={'max_attempts': 0})
+# the certificate we just uploaded to IAM can take a few seconds to show up for
+# ELB. Only for that: the clients already retry throttling and the like.
+cert_propagation_retry = retry.RetryPolicy('cert-propagation', max_attempts=6, base_delay=2,
+                                           retry_codes=['CertificateNotFound'], retry_throttling=False)
+dns_retry = retry.RetryPolicy('dns-propagation', max_attempts=5, base_delay=2,
+                              retry_exceptions=[dns.exception.DNSException])
+
+
+def aws_client(name, region_name=cfg.AWS_REGION):
+    client = boto3.client(name, region_name=region_name, config=aws_config)
+    return retry.RetryingClient(instrumentation.instrument(client), aws_retry)
+
+
 # Global Variables and AWS Resources
-s3 = boto3.resource('s3', region_name=cfg.AWS_REGION)
-cloudfront = boto3.client('cloudfront', region_name=cfg.AWS_REGION)
-iam = boto3.client('iam', region_name=cfg.AWS_REGION)
-sns = boto3.client('sns', region_name=cfg.AWS_REGION)
-elb = boto3.client('elbv2', region_name=cfg.AWS_REGION)
-route53 = boto3.client('route53', region_name=cfg.AWS_REGION)
-
-# Internal files to store user/authorization information
+s3 = boto3.resource('s3', region_name=cfg.AWS_REGION, config=aws_config)
+instrumentation.instrument(s3.meta.client)
+cloudfront = aws_client('cloudfront')
+iam = aws_client('iam')
+sns = aws_client('sns')
+elb = aws_client('elbv2')
+route53 = aws_client('route53')
+acm = aws_client('acm')
+# CloudFront only uses ACM certificates from us-east-1
+acm_cloudfront = aws_client('acm', region_name='us-east-1')
+lambda_c = aws_client('lambda')
+events = aws_client('events')
+
+tracing.configure(tracing.exporters_from_config(getattr(cfg, 'TRACE_EXPORTERS', [])))
+
+# Account, authorization and site state, see manifest.py
+MANIFESTKEY = 'letsencrypt/state.json'
+# Internal files that user/authorization information used to be kept in,
+# moved into the manifest as they're used
 USERFILE = 'letsencrypt_user.json'
 AUTHZRFILE = 'letsencrypt_authzr.json'
+# "Directory" in the config bucket with one file per old certificate to delete
+DELETIONQUEUE = 'letsencrypt/pending-deletions'
+# File the ARN of the SNI certificate deployed for an ELB site used to be kept in
+ELBCERTFILE = 'elb-certificate-arn'
+# Newly issued certificates wait here(encrypted) until they're deployed, so a
+# failed deploy is retried with the same certificate instead of issuing another
+PENDINGCERTFILE = 'pending-cert.json'
+# Which sites have one waiting, in a manifest of its own that's small enough to
+# write as soon as each certificate is issued
+PENDINGKEY = 'letsencrypt/pending.json'
+# Scan for the certificates in use that ran out of time, carried on next run
+# (see referenced_certs). One older than CERTREFS_MAX_AGE(seconds) starts over.
+CERTREFSFILE = 'cert-refs.json'
+CERTREFS_MAX_AGE = 24 * 3600
+
+# Time left in the current invocation, replaced at the start of every run
+budget = TimeBudget()
+# State manifest for the current invocation, also replaced every run
+state = None
+# Certificates waiting to be deployed(see save_pending_cert), replaced every run
+pending_state = None
+# Workers started by an earlier invocation that haven't left their result yet
+# (see collect_workers), replaced every run
+workers = []
+# The sites and domains to manage(see registry.py), kept between warm runs
+fleet = None
+# DOMAINS by name, for finding state from older versions(see legacy_domain_config)
+legacy_domains = {'configs': None}
+# Finds the hosted zones of dns-01 domains without a ROUTE53_ZONE_ID, kept
+# between warm runs(see route53_zone_id)
+zone_resolver = None
+# Notifications to send at the end of the invocation(see send_notifications),
+# replaced by every invocation
+notifications = None
+# Which sites share a certificate when SAN_PACKING is on(see plan_packing)
+packs = {'version': None, 'members': [], 'pack_of': {}}
+# Our IAM certificates, listed once per run(see iam_list_certs)
+iam_certs = None
+
+# The parsed account is kept between runs in a warm container, loading its
+# key means running openssl. 'data' is the manifest entry it was loaded from.
+account_cache = {'data': None, 'user': None}
+# ACME errors that mean the account itself needs looking at(e.g. new terms)
+ACCOUNT_ERROR_CODES = ('unauthorized', 'malformed', 'agreementRequired')
+
+# Rough upper bounds(in seconds) for each unit of work, used to decide when
+# to stop and continue in a new invocation
+EXPIRY_CHECK_SECONDS = 2
+AUTHORIZE_SECONDS = 5
+ISSUE_SECONDS = 15
+DEPLOY_SECONDS = 5
+DISPATCH_SECONDS = 2
+CLEANUP_SECONDS = 5
+# How often the coordinator looks for its workers' results
+RESULT_POLL_SECONDS = 2
+
+# Number of runs to keep trying to delete an old certificate that's in use
+DELETION_ATTEMPTS = 10
+# Number of runs to try deploying an issued certificate before issuing a new one
+DEPLOY_ATTEMPTS = 5
 
 
 # Functions for storing/retrieving/deleting files from our config bucket
-def save_file(site_id, filename, content):
-    s3.Object(cfg.S3CONFIGBUCKET, site_id + "/" + filename).put(Body=content)
+def save_file(site_id, filename, content, **kwargs):
+    metrics.count('s3_sent_bytes', len(content))
+    aws_retry.call(s3.Object(cfg.S3CONFIGBUCKET, site_id + "/" + filename).put, Body=content, **kwargs)
 
 
 def load_file(directory, filename):
     try:
-        obj = s3.Object(cfg.S3CONFIGBUCKET, directory + "/" + filename).get()
-        return obj['Body'].read()
+        obj = aws_retry.call(s3.Object(cfg.S3CONFIGBUCKET, directory + "/" + filename).get)
+        body = obj['Body'].read()
+        metrics.count('s3_received_bytes', len(body))
+        return body
     except botocore.exceptions.ClientError as e:
         if e.response['Error']['Code'] == 'NoSuchKey':
             return False
         return False
 
 
+def delete_file(directory, filename):
+    aws_retry.call(s3.Object(cfg.S3CONFIGBUCKET, directory + "/" + filename).delete)
+
+
 # Verify the bucket exists
 def check_bucket(bucketname):
     try:
-        s3.meta.client.head_bucket(Bucket=bucketname)
+        aws_retry.call(s3.meta.client.head_bucket, Bucket=bucketname)
         exists = True
     except botocore.exceptions.ClientError as e:
         error_code = int(e.response['Error']['Code'])
@@ -72,34 +181,285 @@ def check_bucket(bucketname):
     return exists
 
 
+def load_legacy_state(section, key):
+    # state from before the manifest, stored in a file per account/domain/site
+    if section == 'account' and key == 'user':
+        userfile = load_file('letsencrypt', USERFILE)
+        return json.loads(userfile) if userfile is not False else None
+    if section == 'authorizations':
+        domain = legacy_domain_config(key)
+        if domain is not None:
+            authzrfile = load_file(key, 'authzr-{}.json'.format(domain))
+            return json.loads(authzrfile) if authzrfile is not False else None
+    if section == 'sites':
+        # only ELB SNI sites ever had a file, and an empty entry records that
+        # there's none so it isn't looked for again
+        site = fleet.get_site(key) if fleet is not None else None
+        if site is None or not site.elb_sni:
+            return None
+        arn = load_file(key, ELBCERTFILE)
+        if arn:
+            return {'elb_cert_arn': arn.decode('utf-8') if isinstance(arn, bytes) else arn}
+        return {}
+    return None
+
+
+def legacy_domain_config(name):
+    # The domain's entry in DOMAINS exactly as configured: older versions named
+    # the authorization file after the entry itself('authzr-{'DOMAIN': ...}.json')
+    if legacy_domains['configs'] is None:
+        legacy_domains['configs'] = dict((d.get('DOMAIN'), d) for d in getattr(cfg, 'DOMAINS', None) or [])
+    return legacy_domains['configs'].get(name)
+
+
+def new_state():
+    return manifest.StateManifest(
+        retry.RetryingClient(s3.meta.client, aws_retry),
+        cfg.S3CONFIGBUCKET, MANIFESTKEY,
+        legacy_loader=load_legacy_state
+    )
+
+
+def new_pending_state():
+    # entries left in a site's state by older versions move over as they're read
+    return manifest.StateManifest(
+        retry.RetryingClient(s3.meta.client, aws_retry),
+        cfg.S3CONFIGBUCKET, PENDINGKEY,
+        legacy_loader=lambda section, key: state.get('sites', key, {}).get('pending'),
+        sections=('pending',)
+    )
+
+
+def load_fleet():
+    global fleet
+    if fleet is None:
+        fleet = registry.from_config(
+            cfg, retry.RetryingClient(s3.meta.client, aws_retry),
+            index=registry.ManifestIndex(lambda: state)
+        )
+        packs['version'] = None
+    fleet.refresh()
+    plan_packing()
+    return fleet
+
+
+def packing_enabled():
+    return getattr(cfg, 'SAN_PACKING', False)
+
+
+def plan_packing():
+    # work out which sites share a certificate(see packing.py), again only when
+    # the sites have changed
+    if not packing_enabled() or packs['version'] == fleet.version:
+        return
+    max_names = getattr(cfg, 'SAN_PACKING_MAX_NAMES', packing.MAX_NAMES)
+    with metrics.timer('packing'):
+        members = packing.pack(fleet.sites(), max_names)
+    packs['members'] = members
+    packs['pack_of'] = dict((sid, i) for i, ids in enumerate(members) for sid in ids)
+    packs['version'] = fleet.version
+    logger.info("Packed {} sites into {} certificates".format(len(packs['pack_of']), len(members)))
+
+
+def cert_siblings(site):
+    # ids of the sites sharing a certificate with the site(including itself)
+    if packing_enabled() and site.id in packs['pack_of']:
+        return packs['members'][packs['pack_of'][site.id]]
+    return [sid for sid in fleet.sites_for_domain(site.domains[0])
+            if fleet.get_site(sid).domain_key == site.domain_key]
+
+
+def cert_groups(sites):
+    # the sites as lists of sites that get one certificate between them, in
+    # the order of their first site
+    if not packing_enabled():
+        return model.group_by_domains(sites)
+    groups = {}
+    ordered = []
+    for site in sites:
+        key = packs['pack_of'].get(site.id, site.id)
+        if key not in groups:
+            groups[key] = []
+            ordered.append(groups[key])
+        groups[key].append(site)
+    return ordered
+
+
+def cert_domains(sites):
+    # The names on the certificate for a group of sites: the first site's
+    # domains(the first being the common name), then any the others add
+    names = list(sites[0].domains)
+    seen = set(names)
+    for site in sites[1:]:
+        for name in site.domains:
+            if name not in seen:
+                seen.add(name)
+                names.append(name)
+    return names
+
+
+def save_state():
+    # write the manifests if this run changed anything
+    if pending_state is not None:
+        pending_state.save()
+    if state is not None:
+        state.save()
+
+
+def site_state(site):
+    return dict(state.get('sites', site.id, {}))
+
+
+def update_site_state(site_id, **changes):
+    # a value of None removes the key
+    updated = dict(state.get('sites', site_id, {}))
+    for key, value in changes.items():
+        if value is None:
+            updated.pop(key, None)
+        else:
+            updated[key] = value
+    state.set('sites', site_id, updated)
+
+
+def save_pending_cert(sites, domains, cert, key, chain):
+    # The certificate(for domains) is safely stored for each of the sites
+    # getting it before we try deploying it, and recorded straight away so the
+    # next run knows it's there
+    args = {'ServerSideEncryption': 'aws:kms'}
+    if getattr(cfg, 'PENDING_CERT_KMS_KEY', None):
+        args['SSEKMSKeyId'] = cfg.PENDING_CERT_KMS_KEY
+    body = json.dumps({'cert': cert, 'key': key, 'chain': chain})
+    for site in sites:
+        save_file(site.id, PENDINGCERTFILE, body, **args)
+        pending_state.set('pending', site.id, {'domains': sorted(domains), 'issued_at': time(), 'attempts': 0})
+    pending_state.save()
+
+
+def has_pending_cert(site, domains=None):
+    # domains: the names the certificate should have, the site's own by default
+    pending = pending_state.get('pending', site.id)
+    if pending is None:
+        return False
+    return domains is None or pending['domains'] == sorted(domains)
+
+
+def load_pending_cert(site, domains=None):
+    # (cert, key, chain) issued for the site(with domains, by default its own)
+    # by an earlier run that still needs deploying, or None
+    pending = pending_state.get('pending', site.id)
+    if pending is None:
+        return None
+    if pending['domains'] != sorted(domains or site.domains):
+        logger.info("Domains of {} changed since its certificate was issued, issuing a new one".format(site.name))
+        discard_pending_cert(site)
+        return None
+    if pending['attempts'] >= DEPLOY_ATTEMPTS:
+        logger.warn("Unable to deploy the certificate issued for {} after {} attempts, issuing a new one".format(
+            site.name, pending['attempts']))
+        discard_pending_cert(site)
+        return None
+    data = load_file(site.id, PENDINGCERTFILE)
+    if data is False:
+        logger.warn("The certificate issued for {} is missing, issuing a new one".format(site.name))
+        discard_pending_cert(site)
+        return None
+
+    pending = dict(pending)
+    pending['attempts'] += 1
+    pending_state.set('pending', site.id, pending)
+    data = json.loads(data)
+    return data['cert'], data['key'], data['chain']
+
+
+def discard_pending_cert(site):
+    pending_state.delete('pending', site.id)
+    # from before pending certificates had a manifest of their own
+    if 'pending' in site_state(site):
+        update_site_state(site.id, pending=None)
+    delete_file(site.id, PENDINGCERTFILE)
+
+
 def get_user():
     # Generate a user key to use with letsencrypt
-    userfile = load_file('letsencrypt', USERFILE)
+    userdata = state.get('account', 'user')
+    checked_at = state.get('account', 'checked_at', 0)
     user = None
-    if userfile is not False:
+    if userdata is not None and userdata == account_cache['data']:
+        logger.info("Using cached user")
+        user = account_cache['user']
+    elif userdata is not None:
         logger.info("User key exists, loading...")
-        user = AcmeUser.unserialize(userfile)
-        user.register(cfg.EMAIL)
+        user = AcmeUser.unserialize(json.dumps(userdata))
     else:
         logger.info("Creating user and key")
         user = AcmeUser(keybits=cfg.USERKEY_BITS)
         user.create_key()
+        checked_at = 0
+
+    # The registration only needs checking(and the agreement updating) now
+    # and again, or when the CA complains(see invalidate_account)
+    if time() - checked_at >= getattr(cfg, 'ACCOUNT_CHECK_HOURS', 24) * 3600:
         user.register(cfg.EMAIL)
-        save_file('letsencrypt', USERFILE, user.serialize())
+        checked_at = time()
+    else:
+        logger.info("Account registration checked recently, skipping")
+
+    userdata = json.loads(user.serialize())
+    state.set('account', 'user', userdata)
+    state.set('account', 'checked_at', checked_at)
+    account_cache['data'] = userdata
+    account_cache['user'] = user
     return user
 
 
-def notify_email(subject, message):
-    if cfg.SNS_TOPIC_ARN:
-        logger.info("Sending notification")
-        sns.publish(
-            TopicArn=cfg.SNS_TOPIC_ARN,
-            Subject="[Lambda-LetsEncrypt] {}".format(subject),
-            Message=message
-        )
+def invalidate_account():
+    # check the registration again on the next run
+    account_cache['data'] = None
+    account_cache['user'] = None
+    if state is not None:
+        state.set('account', 'checked_at', 0)
 
 
+def notify_email(subject, message, severity='info'):
+    # Everything but critical errors waits for the digest at the end of the
+    # run, so renewing hundreds of certificates doesn't mean hundreds of emails
+    if not cfg.SNS_TOPIC_ARN:
+        return
+    if severity == 'critical' or not getattr(cfg, 'NOTIFICATION_DIGEST', True):
+        publish_notification(subject, message)
+    else:
+        notifications.add(severity, subject, message)
+
+
+def publish_notification(subject, message):
+    logger.info("Sending notification")
+    sns.publish(
+        TopicArn=cfg.SNS_TOPIC_ARN,
+        Subject="[Lambda-LetsEncrypt] {}".format(subject)[:notify.MAX_SUBJECT],
+        Message=message
+    )
+
+
+def new_digest():
+    return notify.Digest(getattr(cfg, 'NOTIFICATION_DIGEST_MAX_BYTES', notify.MAX_BYTES))
+
+
+def send_notifications(digest):
+    # one message with everything this invocation had to say
+    if not digest.entries:
+        return
+    try:
+        publish_notification(digest.subject(), digest.render())
+    except Exception as e:
+        logger.error("Unable to send the notification digest")
+        logger.error(e)
+    digest.take()
+
+
+@metrics.timed('challenge_solve')
+@tracing.traced('challenge.solve', type='http-01')
 def s3_challenge_solver(domain, token, keyauth, bucket=None, prefix=None):
+    tracing.current().set('domain', domain)
     # logger.info("Writing file {} with content '{}.{}' for domain '{}'".format(token, token, keyauth, domain))
     logger.info("Got prefix {}".format(prefix))
     filename = "{}/.well-known/acme-challenge/{}".format(prefix, token)
@@ -107,36 +467,40 @@ def s3_challenge_solver(domain, token, keyauth, bucket=None, prefix=None):
 
     expires = datetime.datetime.now() + datetime.timedelta(days=3)
     challenge = s3.Object(bucket, filename)
-    challenge.put(
+    aws_retry.call(
+        challenge.put,
         Body=keyauth,
         Expires=expires
     )
-    challenge.Acl().put(ACL='public-read')
+    aws_retry.call(challenge.Acl().put, ACL='public-read')
     return True
 
 
-def http_challenge_verifier(domain, token, keyauth):
-    url = "http://{}/.well-known/acme-challenge/{}".format(domain, token)
-    try:
-        response = urlopen(url)
-        contents = response.read()
-        code = response.getcode()
-    except Exception as e:
-        logger.warn("Failed to verify:")
-        logger.warn(e)
-        return False
-
-    if code != 200:
-        logger.warn("HTTP code {} returned, expected 200".format(code))
-        return False
-    if contents != keyauth:
-        logger.warn("Validation body didn't match, expected '{}', got '{}'".format(keyauth, contents))
-        return False
-
-    return True
+def submit_http_challenges(http_pending):
+    # Check every pending http-01 response at once, and only ask the CA to
+    # validate the ones we could fetch ourselves. The rest stay in the challenge
+    # bucket and get checked again on the next run.
+    with metrics.timer('challenge_verify'), tracing.span('challenge.verify', type='http-01', count=len(http_pending)):
+        readiness = preflight.check_http_tokens(
+            [(authzr.domain, challenge['token'], keyauth) for authzr, challenge, keyauth in http_pending],
+            timeout=getattr(cfg, 'HTTP_PREFLIGHT_TIMEOUT', preflight.DEFAULT_TIMEOUT),
+            schedule=getattr(cfg, 'HTTP_PREFLIGHT_SCHEDULE', preflight.DEFAULT_SCHEDULE),
+            max_workers=getattr(cfg, 'HTTP_PREFLIGHT_WORKERS', preflight.DEFAULT_WORKERS),
+            deadline=budget.deadline()
+        )
+    for authzr, challenge, keyauth in http_pending:
+        if readiness.get(authzr.domain, False):
+            logger.info("http-01 response for '{}' is reachable, submitting challenge".format(authzr.domain))
+            authzr.submit_challenge(challenge, keyauth)
+        else:
+            logger.warn("http-01 response for '{}' is not reachable yet, will retry next run".format(authzr.domain))
+    return readiness
 
 
+@metrics.timed('challenge_solve')
+@tracing.traced('challenge.solve', type='dns-01')
 def route53_challenge_solver(domain, token, keyauth, zoneid=None):
+    tracing.current().set('domain', domain)
     route53.change_resource_record_sets(
         HostedZoneId=zoneid,
         ChangeBatch={
@@ -158,62 +522,70 @@ def route53_challenge_solver(domain, token, keyauth, zoneid=None):
     return True
 
 
+@metrics.timed('challenge_verify')
+@tracing.traced('challenge.verify', type='dns-01')
 def route53_challenge_verifier(domain, token, keyauth):
     # From https://github.com/brendanmckenzie/lambda-letsencrypt/commit/5f7b5b5ed4541f885a4ea090e30b4b82951b42a3
     # DNS propagation may make this somewhat time consuming.
     # try to resolve record '_acme-challenge.domain' and verify that the txt record value matches 'keyauth'
     logger.info('Attempting to verify Route53 challenge')
-    count = 0
+    tracing.current().set('domain', domain)
     record = '_acme-challenge.{}'.format(domain)
-    while count < 5:
-        try:
-            records = dns.resolver.query(record, 'TXT')
-            logger.info('records: {}'.format(records[0]))
-            return records[0].strings[0]
-        except:
-            logger.info('failed')
-            count += 1
-            sleep(5)
+    try:
+        records = dns_retry.call(dns.resolver.query, record, 'TXT')
+        logger.info('records: {}'.format(records[0]))
+        return records[0].strings[0]
+    except dns.exception.DNSException:
+        logger.info('failed')
 
     return False
 
 
-def authorize_domain(user, domain):
-    authzrfilename = 'authzr-{}.json'.format(domain)
-    authzrfile = load_file(domain['DOMAIN'], authzrfilename)
-    if authzrfile is not False:
-        authzr = AcmeAuthorization.unserialize(user, authzrfile)
+@metrics.timed('authorize')
+@tracing.traced('domain')
+def authorize_domain(user, domain, http_pending):
+    tracing.current().set('domain', domain.name)
+    authzrdata = state.get('authorizations', domain.name)
+    if authzrdata is not None:
+        authzr = AcmeAuthorization.unserialize(user, json.dumps(authzrdata))
     else:
-        authzr = AcmeAuthorization(user=user, domain=domain['DOMAIN'])
+        authzr = AcmeAuthorization(user=user, domain=domain.name)
     status = authzr.authorize()
+    tracing.current().set('status', status)
 
     # save the (new/updated) authorization response
-    save_file(domain['DOMAIN'], authzrfilename, authzr.serialize())
+    state.set('authorizations', domain.name, json.loads(authzr.serialize()))
     logger.debug(authzr.serialize())
 
     # see if we're done
     if status == 'pending':
-        if 'http-01' in domain['VALIDATION_METHODS']:
+        if 'http-01' in domain.validation_methods:
             logger.info("Attempting challenge 'http-01'")
-            authzr.complete_challenges(
+            solved = authzr.solve_challenges(
                 "http-01",
-                partial(s3_challenge_solver, bucket=cfg.S3CHALLENGEBUCKET, prefix=domain['CLOUDFRONT_ID']),
-                http_challenge_verifier
-            )
-        if 'dns-01' in domain['VALIDATION_METHODS']:
-            logger.info("Attempting challenge 'dns-01'")
-            authzr.complete_challenges(
-                "dns-01",
-                partial(route53_challenge_solver, zoneid=domain['ROUTE53_ZONE_ID']),
-                route53_challenge_verifier
+                partial(s3_challenge_solver, bucket=cfg.S3CHALLENGEBUCKET, prefix=domain.cloudfront_id)
             )
-        logger.info("Waiting for challenge to be confirmed for '{}'".format(domain['DOMAIN']))
+            # submitted in one batch by submit_http_challenges once they're reachable
+            for challenge, keyauth in solved:
+                http_pending.append((authzr, challenge, keyauth))
+        if 'dns-01' in domain.validation_methods:
+            zone_id = route53_zone_id(domain)
+            if zone_id is None:
+                logger.error("No Route53 hosted zone found for {}, can't use dns-01".format(domain.name))
+            else:
+                logger.info("Attempting challenge 'dns-01'")
+                authzr.complete_challenges(
+                    "dns-01",
+                    partial(route53_challenge_solver, zoneid=zone_id),
+                    route53_challenge_verifier
+                )
+        logger.info("Waiting for challenge to be confirmed for '{}'".format(domain.name))
         return False
     elif status == 'valid':
-        logger.info("Got domain authorization for: {}".format(domain['DOMAIN']))
+        logger.info("Got domain authorization for: {}".format(domain.name))
         return authzr
     else:  # probably failed the challenge
-        logger.warn("Some error happend with authz request for '{}'(review above messages)".format(domain['DOMAIN']))
+        logger.warn("Some error happend with authz request for '{}'(review above messages)".format(domain.name))
         logger.warn("Will retry again next time this runs")
         return False
 
@@ -230,6 +602,8 @@ def iam_upload_cert(certname, cert, key, chain):
             )
             cert_id = newcert['ServerCertificateMetadata']['ServerCertificateId']
             cert_arn = newcert['ServerCertificateMetadata']['Arn']
+            if iam_certs is not None:
+                iam_cache_add(newcert['ServerCertificateMetadata'])
             logger.info("Uploaded cert '{}' ({})".format(certname, cert_id))
             return cert_id, cert_arn
         except botocore.exceptions.ClientError as e:
@@ -238,238 +612,535 @@ def iam_upload_cert(certname, cert, key, chain):
             return False
 
 
-def iam_delete_cert(arn=None, cert_id=None):
-    oldcert_name = None
-    allcerts = iam.list_server_certificates(
-        PathPrefix="/cloudfront/"
-    )
-    for c in allcerts['ServerCertificateMetadataList']:
-        if c['ServerCertificateId'] == cert_id or c['Arn'] == arn:
-            oldcert_name = c['ServerCertificateName']
-            break
-    if not oldcert_name:
-        logger.warn('Unable to find old certificate to delete')
-        return
-    logger.info('Deleting old certificate {}'.format(oldcert_name))
-    retries = 5
-    while retries > 0:
-        try:
-            iam.delete_server_certificate(ServerCertificateName=oldcert_name)
+def iam_list_certs():
+    # Every site's expiry check needs to look up its certificate, so they're
+    # listed once per run and indexed by id and ARN
+    global iam_certs
+    if iam_certs is None:
+        iam_certs = {'all': [], 'by_id': {}, 'by_arn': {}}
+        args = {'PathPrefix': "/cloudfront/"}
+        while True:
+            page = iam.list_server_certificates(**args)
+            for c in page['ServerCertificateMetadataList']:
+                iam_cache_add(c)
+            if not page.get('IsTruncated'):
+                break
+            args['Marker'] = page['Marker']
+    return iam_certs['all']
+
+
+def iam_cache_add(cert):
+    iam_certs['all'].append(cert)
+    iam_certs['by_id'][cert['ServerCertificateId']] = cert
+    iam_certs['by_arn'][cert['Arn']] = cert
+
+
+def queue_cert_deletion(arn=None, cert_id=None, cert_name=None):
+    # Old certificates are usually still in use for a while after being
+    # replaced(e.g. until cloudfront finishes deploying), so rather than wait
+    # around they're queued up and deleted by a later run
+    if cert_name is None:
+        cert = iam_find_cert(arn=arn, cert_id=cert_id)
+        if not cert:
+            logger.warn('Unable to find old certificate to delete')
             return
+        cert_name = cert['ServerCertificateName']
+    logger.info('Queueing old certificate {} for deletion'.format(cert_name))
+    save_file(DELETIONQUEUE, cert_name + '.json', json.dumps({'attempts': 0}))
+
+
+def process_deletion_queue():
+    # Try each queued certificate once, whatever's still in use stays queued
+    queued = aws_retry.call(lambda: list(s3.Bucket(cfg.S3CONFIGBUCKET).objects.filter(Prefix=DELETIONQUEUE + '/')))
+    for obj in queued:
+        filename = obj.key[len(DELETIONQUEUE) + 1:]
+        cert_name = filename[:-len('.json')]
+        entry = json.loads(aws_retry.call(obj.get)['Body'].read())
+        try:
+            iam.delete_server_certificate(ServerCertificateName=cert_name)
+            logger.info('Deleted old certificate {}'.format(cert_name))
+            iam_cache_clear()
         except botocore.exceptions.ClientError as e:
-            # we only retry if it said cert deleteconflict since it may take a few moments
-            # for something to stop using the certificate(e.g. elb)
-            if e.response['Error']['Code'] == 'DeleteConflict':
-                logger.info("Cert in use while trying to delete, retrying...")
-                sleep(5)
+            code = e.response['Error']['Code']
+            if code == 'DeleteConflict' and entry['attempts'] + 1 < DELETION_ATTEMPTS:
+                logger.info("Certificate {} is still in use, will try again next run".format(cert_name))
+                entry['attempts'] += 1
+                save_file(DELETIONQUEUE, filename, json.dumps(entry))
                 continue
+            if code == 'DeleteConflict':
+                logger.warn("Certificate {} is still in use, giving up on deleting it".format(cert_name))
+            elif code != 'NoSuchEntity':
+                logger.error("Unknown error occurred while deleting certificate")
+                logger.error(e)
+                notify_email(
+                    "Unable to delete certificate",
+                    """Lambda-LetsEncrypt failed to delete the certificate '{}'. You should manually do this yourself""".format(cert_name),
+                    severity='error'
+                )
+        delete_file(DELETIONQUEUE, filename)
+
+
+def referenced_certs():
+    # Ids and ARNs of the IAM certificates something still uses: any CloudFront
+    # distribution or load balancer listener(default and SNI certificates), or
+    # recorded in the manifest as deployed. Listing everything can take more
+    # than one run on a big account, so the scan stops when time runs out and
+    # carries on next run, returning None until it's complete.
+    scan = load_cert_refs_scan()
+    while scan['stage'] != 'done':
+        if not budget.has_time(CLEANUP_SECONDS):
+            logger.info("Out of time finding the certificates in use, carrying on next run")
+            scan['refs'] = sorted(scan['refs'])
+            save_file('letsencrypt', CERTREFSFILE, json.dumps(scan))
+            return None
+        scan_cert_refs(scan)
+    if scan['resumed']:
+        delete_file('letsencrypt', CERTREFSFILE)
+
+    refs = scan['refs']
+    refs.update(st['elb_cert_arn'] for st in state.section('sites').values() if st.get('elb_cert_arn'))
+    return refs
+
+
+def load_cert_refs_scan():
+    saved = load_file('letsencrypt', CERTREFSFILE)
+    if saved is not False:
+        scan = json.loads(saved)
+        if time() - scan['started'] < CERTREFS_MAX_AGE:
+            scan['refs'] = set(scan['refs'])
+            scan['resumed'] = True
+            return scan
+    return {'started': time(), 'stage': 'cloudfront', 'marker': None, 'lbs': [], 'refs': set(), 'resumed': saved is not False}
+
+
+def scan_cert_refs(scan):
+    # One step of the scan: a page of distributions or load balancers, or the
+    # listeners of one load balancer
+    args = {'Marker': scan['marker']} if scan['marker'] else {}
+    if scan['stage'] == 'cloudfront':
+        page = cloudfront.list_distributions(**args)['DistributionList']
+        for dist in page.get('Items', []):
+            cert_id = dist.get('ViewerCertificate', {}).get('IAMCertificateId')
+            if cert_id:
+                scan['refs'].add(cert_id)
+        scan['marker'] = page['NextMarker'] if page.get('IsTruncated') else None
+        if not scan['marker']:
+            scan['stage'] = 'elb'
+    elif scan['stage'] == 'elb':
+        page = elb.describe_load_balancers(**args)
+        scan['lbs'] = [lb['LoadBalancerArn'] for lb in page['LoadBalancers']]
+        scan['marker'] = page.get('NextMarker')
+        scan['stage'] = 'listeners'
+    else:
+        if scan['lbs']:
+            lb_arn = scan['lbs'].pop(0)
+            for listener in elb.describe_listeners(LoadBalancerArn=lb_arn)['Listeners']:
+                scan['refs'].update(c['CertificateArn'] for c in listener.get('Certificates', []))
+                # SNI certificates, on ALB(HTTPS) and NLB(TLS) listeners
+                if listener.get('Protocol', 'HTTPS') in ('HTTPS', 'TLS'):
+                    scan['refs'].update(elb_listener_cert_arns(listener['ListenerArn']))
+        if not scan['lbs']:
+            scan['stage'] = 'elb' if scan['marker'] else 'done'
+
+
+def collect_orphaned_certs(sites):
+    # Certificates we uploaded(named after one of the sites, see deploy_group)
+    # that nothing uses anymore, e.g. left behind by a failed deploy or a
+    # deletion that gave up. IAM doesn't stop you deleting a certificate a
+    # listener is using, so anything referenced is left alone.
+    prefixes = set(site.id + '_' for site in sites)
+    grace = datetime.datetime.now(tz=tzutc()) - datetime.timedelta(days=1)
+    try:
+        refs = referenced_certs()
+    except botocore.exceptions.ClientError as e:
+        logger.error("Unable to find out which certificates are in use, not collecting any")
+        logger.error(e)
+        return
+    if refs is None:
+        return
 
-            logger.error("Unknown error occurred while deleting certificate")
-            logger.error(e)
-            notify_email(
-                "Unable to delete certificate",
-                """Lambda-LetsEncrypt failed to delete the certificate '{}'. You should manually do this yourself""".format(oldcert_name)
-            )
-            break
+    for c in iam_list_certs():
+        name = c['ServerCertificateName']
+        prefix = name[:name.rfind('_', 0, name.rfind('_')) + 1]
+        if prefix not in prefixes or c['UploadDate'] >= grace:
+            continue
+        if c['ServerCertificateId'] in refs or c['Arn'] in refs:
+            continue
+        queue_cert_deletion(cert_name=name)
 
 
-def iam_check_expiration(arn=None, cert_id=None):
-    allcerts = iam.list_server_certificates(PathPrefix="/cloudfront/")
-    expiration = None
-    cert = None
-    for c in allcerts['ServerCertificateMetadataList']:
-        if c['ServerCertificateId'] == cert_id or c['Arn'] == arn:
-            cert = c
-            break
-    if not cert:
-        # no expiration found?
-        return True
-    expiration = cert['Expiration']
+def iam_cache_clear():
+    global iam_certs
+    iam_certs = None
+
+
+def iam_find_cert(arn=None, cert_id=None):
+    iam_list_certs()
+    return iam_certs['by_id'].get(cert_id) or iam_certs['by_arn'].get(arn)
+
+
+def site_renewal_days(site_id):
+    # each site renews at its own(stable) point in the renewal window
+    return renewal.renewal_days(site_id, tuple(getattr(cfg, 'RENEWAL_WINDOW_DAYS', renewal.DEFAULT_WINDOW)))
+
+
+def check_expiration(cert_name, expiration, renewal_days):
     time_left = expiration - datetime.datetime.now(tz=tzutc())
 
     if time_left.days < 10:
-        logger.warn("Only {} days left on cert {}!".format(time_left.days, cert['ServerCertificateName']))
+        logger.warn("Only {} days left on cert {}!".format(time_left.days, cert_name))
         notify_email(
-            'Less than 10 days left on cert {}'.format(cert['ServerCertificateName']),
+            'Less than 10 days left on cert {}'.format(cert_name),
             """
 There's less than 10 days left on your certificate for {}. This probably
 means the lambda function that is supposed to be handling the renewal is
 failing. Please check the logs for it. Attempting to renew now.
-""".format(cert['ServerCertificateName'])
+""".format(cert_name),
+            severity='warning'
         )
         return True
-    elif time_left.days < 30:
-        logger.info("Only {} days remaining, will proceed with renewal for {}".format(time_left.days, cert['ServerCertificateName']))
+    elif time_left.days < renewal_days:
+        logger.info("Only {} days remaining, will proceed with renewal for {}".format(time_left.days, cert_name))
         return True
     else:
-        logger.info("{} days remaining on cert, nothing to do for {}.".format(time_left.days, cert['ServerCertificateName']))
+        logger.info("{} days remaining on cert, nothing to do for {}.".format(time_left.days, cert_name))
         return False
 
 
-def is_elb_cert_expiring(site):
+def iam_cert_expiration(arn=None, cert_id=None):
+    cert = iam_find_cert(arn=arn, cert_id=cert_id)
+    if not cert:
+        return None
+    return cert['ServerCertificateName'], cert['Expiration']
+
+
+def acm_cert_expiration(client, arn):
+    try:
+        cert = client.describe_certificate(CertificateArn=arn)['Certificate']
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] == 'ResourceNotFoundException':
+            return None
+        raise
+    return arn, cert['NotAfter']
+
+
+def is_acm_arn(arn):
+    return arn.startswith('arn:aws:acm:')
+
+
+def elb_listeners(site):
+    # the listeners on the site's load balancer for each of the site's ports
     try:
         load_balancers = elb.describe_load_balancers(
-            Names=[site['ELB_NAME']],
+            Names=[site.elb_name],
         )
     except botocore.exceptions.ClientError as e:
-        logger.error("Error getting information about Elastic Load Balancer '{}'".format(site['ELB_NAME']))
+        logger.error("Error getting information about Elastic Load Balancer '{}'".format(site.elb_name))
         logger.error(e)
         raise
 
-    currentcert_arn = None
+    ports = site.elb_ports
+    found = []
     for lb in load_balancers['LoadBalancers']:
-        if lb['LoadBalancerName'] != site['ELB_NAME']:
+        if lb['LoadBalancerName'] != site.elb_name:
             continue
         listeners = elb.describe_listeners(
             LoadBalancerArn=lb['LoadBalancerArn']
         )['Listeners']
-        for listener in listeners:
-            if listener['Port'] != site['ELB_PORT']:
-                continue
-            if len(listener['Certificates']) > 0:
-                currentcert_arn = listener['Certificates'][0]['CertificateArn']
-    if currentcert_arn is None:
-        logger.info("No certificate exists for elb name {}".format(site['ELB_NAME']))
-        return True
-    else:
-        return iam_check_expiration(arn=currentcert_arn)
+        found.extend(listener for listener in listeners if listener['Port'] in ports)
 
-def is_cf_cert_expiring(site):
-    cf_config = cloudfront.get_distribution_config(Id=site['CLOUDFRONT_ID'])
-    currentcert = cf_config['DistributionConfig']['ViewerCertificate'].get('IAMCertificateId', None)
+    missing = set(ports) - set(listener['Port'] for listener in found)
+    if missing:
+        logger.warning("No listener on port(s) {} for elb name {}".format(
+            ",".join(str(p) for p in sorted(missing)), site.elb_name))
+    return found
 
-    if currentcert is None:
-        logger.info("No certificate exists for {}".format(site['CLOUDFRONT_ID']))
-        return True
 
-    return iam_check_expiration(cert_id=currentcert)
+def elb_listener_cert_arns(listener_arn):
+    # every certificate on a listener, the default one and the SNI ones
+    args = {'ListenerArn': listener_arn}
+    arns = []
+    while True:
+        page = elb.describe_listener_certificates(**args)
+        arns.extend(c['CertificateArn'] for c in page['Certificates'])
+        if not page.get('NextMarker'):
+            return arns
+        args['Marker'] = page['NextMarker']
 
 
-def is_domain_expiring(site):
-    if 'CLOUDFRONT_ID' in site:
-        return is_cf_cert_expiring(site)
-    if 'ELB_NAME' in site:
-        return is_elb_cert_expiring(site)
-    logger.error("Can't detect site type(ELB or CLOUDFRONT)")
-    return False
+def elb_sni_cert_arn(site):
+    # The SNI certificate we last deployed for the site, there's nothing on the
+    # listener itself to tell which site an SNI certificate belongs to
+    return site_state(site).get('elb_cert_arn')
 
 
-def configure_cert(site, cert, key, chain):
-    certname = "{}_{}".format(site_id(site), strftime("%Y%m%d_%H%M%S", gmtime()))
-    cert_id, cert_arn = iam_upload_cert(certname, cert, key, chain)
+def elb_current_cert_arn(site):
+    listeners = elb_listeners(site)
+    if not listeners:
+        return None
 
-    f = None
-    if 'CLOUDFRONT_ID' in site:
-        f = cloudfront_configure_cert
-    if 'ELB_NAME' in site:
-        f = elb_configure_cert
-    if f is None:
-        logger.error("Can't detect site type when configuring certificate(ELB or CLOUDFRONT)")
-
-    ret = False
-    retries = 5
-    while retries > 0:
-        retries -= 1
-        try:
-            ret = f(site, cert_id, cert_arn)
-            break
-        except botocore.exceptions.ClientError as e:
-            # we only retry if it said cert not found
-            if e.response['Error']['Code'] == 'CertificateNotFound':
-                logger.info("Cert not found when trying to configure ELB, retrying...")
-                sleep(5)
-                continue
+    if site.elb_sni:
+        currentcert_arn = elb_sni_cert_arn(site)
+        # only count it if it's still on every one of the site's listeners
+        for listener in listeners:
+            if currentcert_arn not in elb_listener_cert_arns(listener['ListenerArn']):
+                return None
+        return currentcert_arn
 
-            logger.error("Unknown error occurred while updating certificate")
-            logger.error(e)
-            ret = False
-            break
+    currentcert_arn = None
+    for listener in listeners:
+        if len(listener['Certificates']) > 0:
+            currentcert_arn = listener['Certificates'][0]['CertificateArn']
+    return currentcert_arn
 
-    return ret
 
+def elb_current_cert(site):
+    currentcert_arn = elb_current_cert_arn(site)
+    if currentcert_arn is None:
+        logger.info("No certificate exists for elb name {}".format(site.elb_name))
+        return None
+    if is_acm_arn(currentcert_arn):
+        return acm_cert_expiration(acm, currentcert_arn)
+    return iam_cert_expiration(arn=currentcert_arn)
+
+
+def cf_current_cert(site):
+    cf_config = cloudfront.get_distribution_config(Id=site.cloudfront_id)
+    viewer_cert = cf_config['DistributionConfig']['ViewerCertificate']
+
+    if viewer_cert.get('ACMCertificateArn'):
+        return acm_cert_expiration(acm_cloudfront, viewer_cert['ACMCertificateArn'])
+    if viewer_cert.get('IAMCertificateId'):
+        return iam_cert_expiration(cert_id=viewer_cert['IAMCertificateId'])
+    logger.info("No certificate exists for {}".format(site.cloudfront_id))
+    return None
+
+
+@metrics.timed('expiry_check')
+@tracing.traced('expiry_check')
+def is_domain_expiring(site, expirations=None):
+    tracing.current().set('site_id', site.id)
+    # expirations(if given) gets the expiration date of the site's current cert
+    if site.kind == model.CLOUDFRONT:
+        cert = cf_current_cert(site)
+    else:
+        cert = elb_current_cert(site)
 
-def elb_configure_cert(site, cert_id, cert_arn):
-    # get the current certificate for the load balancer(if there is one)
-    load_balancers = elb.describe_load_balancers(
-        Names=[site['ELB_NAME']],
+    if not cert:
+        # no expiration found?
+        return True
+    cert_name, expiration = cert
+    if expirations is not None:
+        expirations[site.id] = expiration
+    fleet.record_expiration(site.id, expiration)
+    return check_expiration(cert_name, expiration, site_renewal_days(site.id))
+
+
+def acm_import_cert(site, cert, key, chain):
+    # Returns (arn, reimported). Reimporting over the site's existing ACM
+    # certificate replaces it in place, so nothing else needs updating.
+    if site.kind == model.CLOUDFRONT:
+        client = acm_cloudfront
+        cf_config = cloudfront.get_distribution_config(Id=site.cloudfront_id)
+        current_arn = cf_config['DistributionConfig']['ViewerCertificate'].get('ACMCertificateArn')
+    else:
+        client = acm
+        current_arn = elb_current_cert_arn(site)
+        if current_arn and not is_acm_arn(current_arn):
+            current_arn = None
+
+    args = {
+        'Certificate': cert,
+        'PrivateKey': key,
+        'CertificateChain': chain
+    }
+    if current_arn:
+        args['CertificateArn'] = current_arn
+    try:
+        imported = client.import_certificate(**args)
+    except botocore.exceptions.ClientError as e:
+        logger.error("Error importing certificate into ACM:")
+        logger.error(e)
+        return None, False
+    if current_arn:
+        logger.info("Reimported ACM certificate {} for {}".format(current_arn, site.name))
+        return current_arn, True
+
+    client.add_tags_to_certificate(
+        CertificateArn=imported['CertificateArn'],
+        Tags=[{'Key': 'lambda-letsencrypt', 'Value': site.id}]
     )
-    
-    for lb in load_balancers['LoadBalancers']:
-        if lb['LoadBalancerName'] != site['ELB_NAME']:
-            continue
-        listeners = elb.describe_listeners(
-            LoadBalancerArn=lb['LoadBalancerArn']
-        )['Listeners']
-        for listener in listeners:
-            if listener['Port'] != site['ELB_PORT']:
+    logger.info("Imported ACM certificate {} for {}".format(imported['CertificateArn'], site.name))
+    return imported['CertificateArn'], False
+
+
+@metrics.timed('deploy')
+def configure_cert(site, cert, key, chain, elb_changes=None, uploaded=None):
+    # elb_changes(an ElbCertChanges) batches up listener updates for ELB sites,
+    # they aren't made until elb_changes.apply() is called. uploaded is the
+    # (cert_id, cert_arn) of the certificate if it's already in IAM.
+    if site.backend == 'acm':
+        cert_id = None
+        cert_arn, reimported = acm_import_cert(site, cert, key, chain)
+        if cert_arn is None:
+            return False
+        if reimported:
+            return True
+    else:
+        if uploaded is None:
+            certname = "{}_{}".format(site.id, strftime("%Y%m%d_%H%M%S", gmtime()))
+            uploaded = iam_upload_cert(certname, cert, key, chain)
+        if not uploaded:
+            return False
+        cert_id, cert_arn = uploaded
+
+    if site.kind == model.CLOUDFRONT:
+        f = cloudfront_configure_cert
+    else:
+        f = partial(elb_configure_cert, changes=elb_changes)
+
+    try:
+        return cert_propagation_retry.call(f, site, cert_id, cert_arn)
+    except botocore.exceptions.ClientError as e:
+        logger.error("Unknown error occurred while updating certificate")
+        logger.error(e)
+        return False
+
+
+class ElbCertChanges:
+    """ Certificate changes for ELB listeners, collected so each listener gets
+    a single call per kind of change however many sites share it """
+
+    def __init__(self):
+        self.listeners = {}
+        self.sni_certs = {}
+
+    def _listener(self, listener_arn, site):
+        change = self.listeners.setdefault(listener_arn, {
+            'default': None,
+            'add': [],
+            'remove': [],
+            'retired': [],
+            'sites': [],
+        })
+        if site.id not in change['sites']:
+            change['sites'].append(site.id)
+        return change
+
+    def set_default(self, listener_arn, cert_arn, old_arn, site):
+        change = self._listener(listener_arn, site)
+        if change['default'] is not None:
+            logger.warning("More than one site is setting the default certificate of listener {}".format(listener_arn))
+        change['default'] = cert_arn
+        if old_arn and old_arn != cert_arn and old_arn not in change['retired']:
+            change['retired'].append(old_arn)
+
+    def add_sni(self, listener_arn, cert_arn, old_arn, site):
+        change = self._listener(listener_arn, site)
+        if cert_arn not in change['add']:
+            change['add'].append(cert_arn)
+        if old_arn and old_arn != cert_arn and old_arn not in change['remove']:
+            change['remove'].append(old_arn)
+            change['retired'].append(old_arn)
+        self.sni_certs[site.id] = cert_arn
+
+    def apply(self):
+        """ Makes the changes, returns the ids of sites that failed """
+        failed = set()
+        retired = set()
+        # An SNI certificate can be shared by several sites(see issue_group),
+        # it stays on the listener while any site we aren't changing has it
+        in_use = set(st.get('elb_cert_arn') for sid, st in state.section('sites').items()
+                     if sid not in self.sni_certs)
+        for listener_arn, change in self.listeners.items():
+            change['remove'] = [arn for arn in change['remove'] if arn not in in_use]
+            change['retired'] = [arn for arn in change['retired'] if arn not in in_use]
+            try:
+                # an IAM certificate we just uploaded can take a few seconds to show up for ELB
+                if change['default']:
+                    cert_propagation_retry.call(
+                        elb.modify_listener,
+                        ListenerArn=listener_arn,
+                        Certificates=[{'CertificateArn': change['default']}]
+                    )
+                if change['add']:
+                    cert_propagation_retry.call(
+                        elb.add_listener_certificates,
+                        ListenerArn=listener_arn,
+                        Certificates=[{'CertificateArn': arn} for arn in change['add']]
+                    )
+                if change['remove']:
+                    elb.remove_listener_certificates(
+                        ListenerArn=listener_arn,
+                        Certificates=[{'CertificateArn': arn} for arn in change['remove']]
+                    )
+            except botocore.exceptions.ClientError as e:
+                logger.error("Error updating certificates of listener {}".format(listener_arn))
+                logger.error(e)
+                failed.update(change['sites'])
                 continue
-            oldcert_arn = None
-            if len(listener['Certificates']) > 0:
-                oldcert_arn = listener['Certificates'][0]['CertificateArn']
-            if oldcert_arn:
-                # Set up the new certificate
-                elb.modify_listener(
-                    ListenerArn=listener['ListenerArn'],
-                    Certificates=[{
-                        'CertificateArn': cert_arn
-                    }]
-                )
-                # Delete the old certificate if it existed
-                iam_delete_cert(arn=oldcert_arn)
-            else:
-                logger.info("No listener exists for specified port")
-                logger.error("Creating new listeners not supported yet! Please create one first manually, or implement elbv2 version of the code below :)")
-                return False
-                # if there wasn't an old cert, we need to configure the elb for HTTPS
-                # logger.info("No listener exists for specified port, creating default")
-                # create a load balancer policy
-                # logger.debug("Creating load balancer policy")
-                # elb.create_load_balancer_policy(
-                #     LoadBalancerName=site['ELB_NAME'],
-                #     PolicyName="lambda-letsencrypt-default-ssl-policy",
-                #     PolicyTypeName="SSLNegotiationPolicyType",
-                #     PolicyAttributes=[{
-                #         'AttributeName': 'Reference-Security-Policy',
-                #         'AttributeValue': 'ELBSecurityPolicy-2015-05'
-                #     }]
-                # )
-                # # create a load balancer listener
-                # logger.debug("Creating load balancer listener")
-                # elb.create_load_balancer_listeners(
-                #     LoadBalancerName=site['ELB_NAME'],
-                #     Listeners=[{
-                #         'Protocol': 'HTTPS',
-                #         'LoadBalancerPort': site['ELB_PORT'],
-                #         'InstanceProtocol': 'HTTP',
-                #         'InstancePort': 80,
-                #         'SSLCertificateId': cert_arn
-                #     }]
-                # )
-                # # associate policy with the listener
-                # logger.debug("Setting load balancer listener policy")
-                # elb.set_load_balancer_policies_of_listener(
-                #     LoadBalancerName=site['ELB_NAME'],
-                #     LoadBalancerPort=site['ELB_PORT'],
-                #     PolicyNames=['lambda-letsencrypt-default-ssl-policy']
-                # )
-            
-    
+            retired.update(change['retired'])
+
+        # Delete the old certificates(ACM ones get reimported instead)
+        for arn in retired:
+            if not is_acm_arn(arn):
+                queue_cert_deletion(arn=arn)
+
+        for sid, cert_arn in self.sni_certs.items():
+            if sid not in failed:
+                update_site_state(sid, elb_cert_arn=cert_arn)
+        self.listeners = {}
+        self.sni_certs = {}
+        return failed
+
+
+def elb_configure_cert(site, cert_id, cert_arn, changes=None):
+    # Without a changes batch to add to the listeners are updated straight away
+    apply_now = changes is None
+    if apply_now:
+        changes = ElbCertChanges()
+
+    listeners = elb_listeners(site)
+    if not listeners:
+        logger.error("Creating new listeners not supported yet! Please create one first manually")
+        return False
+
+    old_sni_arn = elb_sni_cert_arn(site) if site.elb_sni else None
+    for listener in listeners:
+        if site.elb_sni:
+            changes.add_sni(listener['ListenerArn'], cert_arn, old_sni_arn, site)
+            continue
+        oldcert_arn = None
+        if len(listener['Certificates']) > 0:
+            oldcert_arn = listener['Certificates'][0]['CertificateArn']
+        changes.set_default(listener['ListenerArn'], cert_arn, oldcert_arn, site)
+
+    if apply_now:
+        return site.id not in changes.apply()
     return True
 
 
 def cloudfront_configure_cert(site, cert_id, cert_arn):
     # get current cloudfront distribution settings
-    cf_config = cloudfront.get_distribution_config(Id=site['CLOUDFRONT_ID'])
+    cf_config = cloudfront.get_distribution_config(Id=site.cloudfront_id)
     oldcert_id = cf_config['DistributionConfig']['ViewerCertificate'].get('IAMCertificateId', None)
 
     # Make sure the default cloudfront cert isn't being used
     if 'CloudFrontDefaultCertificate' in cf_config['DistributionConfig']['ViewerCertificate']:
         del cf_config['DistributionConfig']['ViewerCertificate']['CloudFrontDefaultCertificate']
 
-    # update it to point to the new cert
-    cf_config['DistributionConfig']['ViewerCertificate']['IAMCertificateId'] = cert_id
-    cf_config['DistributionConfig']['ViewerCertificate']['Certificate'] = cert_id
-    cf_config['DistributionConfig']['ViewerCertificate']['CertificateSource'] = 'iam'
+    # update it to point to the new cert(IAM, or ACM if there's no cert_id)
+    viewer_cert = cf_config['DistributionConfig']['ViewerCertificate']
+    if cert_id:
+        viewer_cert.pop('ACMCertificateArn', None)
+        viewer_cert['IAMCertificateId'] = cert_id
+        viewer_cert['Certificate'] = cert_id
+        viewer_cert['CertificateSource'] = 'iam'
+    else:
+        viewer_cert.pop('IAMCertificateId', None)
+        viewer_cert['ACMCertificateArn'] = cert_arn
+        viewer_cert['Certificate'] = cert_arn
+        viewer_cert['CertificateSource'] = 'acm'
     # make sure we use SNI only(otherwise the bill can be quite large, $600/month or so)
     cf_config['DistributionConfig']['ViewerCertificate']['MinimumProtocolVersion'] = 'TLSv1'
     cf_config['DistributionConfig']['ViewerCertificate']['SSLSupportMethod'] = 'sni-only'
@@ -477,17 +1148,18 @@ def cloudfront_configure_cert(site, cert_id, cert_arn):
     # actually update the distribution
     cloudfront.update_distribution(
         DistributionConfig=cf_config['DistributionConfig'],
-        Id=site['CLOUDFRONT_ID'],
+        Id=site.cloudfront_id,
         IfMatch=cf_config['ETag']
     )
 
     # delete the old cert
-    iam_delete_cert(cert_id=oldcert_id)
+    if oldcert_id:
+        queue_cert_deletion(cert_id=oldcert_id)
     return True
 
 
 def configure_cloudfront(domain, s3bucket):
-    cf_config = cloudfront.get_distribution_config(Id=domain['CLOUDFRONT_ID'])
+    cf_config = cloudfront.get_distribution_config(Id=domain.cloudfront_id)
     changed = False
     # make sure we have the origin configured
     origins = cf_config['DistributionConfig']['Origins']['Items']
@@ -500,7 +1172,7 @@ def configure_cloudfront(domain, s3bucket):
         cf_config['DistributionConfig']['Origins']['Items'].append({
             'DomainName': '{}.s3.amazonaws.com'.format(s3bucket),
             'Id': 'lambda-letsencrypt-challenges',
-            'OriginPath': "/{}".format(domain['CLOUDFRONT_ID']),
+            'OriginPath': "/{}".format(domain.cloudfront_id),
             'CustomHeaders': {u'Quantity': 0},
             'S3OriginConfig': {u'OriginAccessIdentity': ''}
         })
@@ -554,7 +1226,7 @@ def configure_cloudfront(domain, s3bucket):
         try:
             cloudfront.update_distribution(
                 DistributionConfig=cf_config['DistributionConfig'],
-                Id=domain['CLOUDFRONT_ID'],
+                Id=domain.cloudfront_id,
                 IfMatch=cf_config['ETag']
             )
         except Exception as e:
@@ -562,28 +1234,13 @@ def configure_cloudfront(domain, s3bucket):
             logger.error(e)
 
 
-def site_name(site):
-    if 'CLOUDFRONT_ID' in site:
-        return "CloudFront Distribution '{}'".format(site['CLOUDFRONT_ID'])
-    elif 'ELB_NAME' in site:
-        return "ELB Name '{}'".format(site['ELB_NAME'])
-
-
-def site_id(site):
-    if 'CLOUDFRONT_ID' in site:
-        return "cfd-{}".format(site['CLOUDFRONT_ID'])
-    elif 'ELB_NAME' in site:
-        return 'elb-{}'.format(site['ELB_NAME'])
-
-
-def lambda_handler(event, context):
-    action_needed = False
-    # Do a few sanity checks
+def check_buckets():
     if not check_bucket(cfg.S3CONFIGBUCKET):
         logger.error("S3 configuration bucket does not exist")
         notify_email(
             "Lambda-LetsEncrypt config bucket missing {}".format(cfg.S3CONFIGBUCKET),
-            "S3 Configuration bucket {} required for managing certificates in {} is missing".format(cfg.S3CONFIGBUCKET, cfg.SITES)
+            "S3 Configuration bucket {} required for managing certificates is missing".format(cfg.S3CONFIGBUCKET),
+            severity='critical'
         )
         return False
 
@@ -591,63 +1248,595 @@ def lambda_handler(event, context):
         logger.error("S3 challenge bucket does not exist")
         notify_email(
             "Lambda-LetsEncrypt challenge bucket missing {}".format(cfg.S3CHALLENGEBUCKET),
-            "S3 Challenge bucket {} required for LetsEncrypt verifications in {} is missing".format(cfg.S3CHALLENGEBUCKET, cfg.SITES)
+            "S3 Challenge bucket {} required for LetsEncrypt verifications is missing".format(cfg.S3CHALLENGEBUCKET),
+            severity='critical'
         )
         return False
+    return True
 
-    # check the certificates we want issued
-    for site in cfg.SITES:
-        if not is_domain_expiring(site):
-            site['skip'] = True
-            continue
-        action_needed = True
 
-    # quit if there's nothing to do
-    if not action_needed:
-        return False
+def save_checkpoint(sites):
+    name = 'checkpoint-{}.json'.format(uuid.uuid4().hex)
+    save_file('letsencrypt', name, json.dumps({'sites': [site.id for site in sites]}))
+    return name
+
+
+def load_checkpoint(name):
+    checkpoint = load_file('letsencrypt', name)
+    if checkpoint is False:
+        return None
+    delete_file('letsencrypt', name)
+    remaining = json.loads(checkpoint)['sites']
+    return [fleet.get_site(sid) for sid in remaining if fleet.get_site(sid) is not None]
+
+
+def continue_later(context, sites, continuation, report, mode='worker'):
+    # Save the sites we didn't get to and hand them off to a fresh invocation
+    # of ourselves, rather than getting killed part way through a site.
+    waiting = [sid for worker in workers for sid in worker['sites']]
+    if continuation >= getattr(cfg, 'MAX_CONTINUATIONS', 10):
+        logger.error("Giving up after {} continuations, {} site(s) left".format(continuation, len(sites)))
+        if waiting:
+            logger.error("No result from the workers for {}".format(", ".join(waiting)))
+        notify_email("Unable to finish processing sites",
+                     "Lambda-LetsEncrypt ran out of time too many times and still has {} site(s) left to process. ".format(len(sites)) +
+                     "Please review the logs in cloudwatch.", severity='error')
+        for site in sites:
+            report[site.id] = 'failed'
+        for sid in waiting:
+            report[sid] = 'failed'
+        return
+
+    logger.info("Running low on time, continuing {} site(s) in a new invocation".format(len(sites)))
+    # the next invocation starts from the saved state
+    save_state()
+    payload = {
+        'resume': save_checkpoint(sites),
+        'continuation': continuation + 1,
+        'mode': mode,
+        'trace': tracing.context()
+    }
+    if workers:
+        # it collects the results we didn't get to wait for
+        payload['workers'] = workers
+    lambda_c.invoke(
+        FunctionName=context.invoked_function_arn,
+        InvocationType='Event',
+        Payload=json.dumps(payload)
+    )
+    for site in sites:
+        report[site.id] = 'continued'
+    for sid in waiting:
+        report[sid] = 'continued'
+
+
+def sites_due_soon():
+    # Without a horizon every site is checked, otherwise only the ones that
+    # aren't known to be good for at least that long
+    horizon = getattr(cfg, 'REGISTRY_HORIZON_DAYS', None)
+    if horizon is None:
+        return fleet.sites()
+    until = datetime.datetime.now(tz=tzutc()) + datetime.timedelta(days=horizon)
+    sites = []
+    for page in fleet.due_sites(until, site_renewal_days):
+        sites.extend(page)
+    logger.info("{} of {} site(s) are due within {} day(s)".format(len(sites), len(fleet.sites()), horizon))
+    return sites
+
+
+def select_sites(event):
+    # pick up where a previous invocation left off
+    if event.get('resume'):
+        sites = load_checkpoint(event['resume'])
+        if sites is not None:
+            return sites
+        logger.warn("No checkpoint found to resume from, checking all sites")
+        return fleet.sites()
+
+    # or just the site(s) we were asked to handle
+    if 'site' in event:
+        wanted = [event['site']]
+    elif 'sites' in event:
+        wanted = event['sites']
+    else:
+        return sites_due_soon()
+    sites = [fleet.get_site(sid) for sid in wanted if fleet.get_site(sid) is not None]
+    unknown = set(wanted) - set(site.id for site in sites)
+    if unknown:
+        logger.warn("Unknown site(s) requested: {}".format(", ".join(sorted(unknown))))
+    return sites
+
 
+@metrics.timed('plan')
+def find_due_sites(context, sites, continuation, report, expirations, mode='worker'):
+    # check the certificates we want issued
+    due_sites = []
+    for i, site in enumerate(sites):
+        if i > 0 and not budget.has_time(EXPIRY_CHECK_SECONDS):
+            continue_later(context, due_sites + sites[i:], continuation, report, mode)
+            return None
+        if is_domain_expiring(site, expirations):
+            due_sites.append(site)
+        else:
+            report[site.id] = 'not-due'
+            if has_pending_cert(site):
+                # deployed after all(e.g. the run died before it could tidy up)
+                discard_pending_cert(site)
+    return renewal.by_urgency(with_siblings(due_sites, report), expirations, lambda site: site.id)
+
+
+def with_siblings(due_sites, report):
+    # Sites sharing a certificate(see issue_group) are renewed together even
+    # if the others aren't quite due yet
+    due_ids = set(site.id for site in due_sites)
+    siblings = []
+    for site in due_sites:
+        for sid in cert_siblings(site):
+            sibling = fleet.get_site(sid)
+            if sid not in due_ids and sibling is not None:
+                logger.info("Renewing {} along with {}".format(sibling.name, site.name))
+                due_ids.add(sid)
+                siblings.append(sibling)
+                report.pop(sid, None)
+    return due_sites + siblings
+
+
+def max_issuances():
+    return getattr(cfg, 'MAX_ISSUANCES_PER_RUN', None)
+
+
+def defer(sites, report):
+    for site in sites:
+        logger.info("Reached the maximum number of certificates to issue per run, deferring {}".format(site.name))
+        report[site.id] = 'deferred'
+
+
+def report_configured(site, ok, report):
+    if ok:
+        report[site.id] = 'issued'
+        # check the new certificate's expiration next run
+        fleet.forget_expiration(site.id)
+        discard_pending_cert(site)
+        notify_email("Certificate issued",
+                     "The certificate for {} has been successfully updated".format(site.name))
+    else:
+        report[site.id] = 'failed'
+        notify_email("Error issuing cert",
+                     "There was some sort of error configuring the site({}) with the certificate.".format(site.name) +
+                     "Please review the logs in cloudwatch.", severity='error')
+
+
+def apply_elb_changes(elb_changes, configured, report):
+    # make the batched ELB listener changes, then report on every configured site
+    with metrics.timer('deploy'):
+        failed = elb_changes.apply()
+    for site in configured:
+        report_configured(site, site.id not in failed, report)
+    del configured[:]
+
+
+def issue_group(user, sites, elb_changes):
+    # The sites get one certificate between them(see cert_groups).
+    # Returns [(site, configured)].
+    lead = sites[0]
+    domains = cert_domains(sites)
+    with tracing.span('site', site_id=lead.id, domains=",".join(domains)) as span:
+        span.set('sites', ",".join(site.id for site in sites))
+        pending = load_pending_cert(lead, domains)
+        if pending is not None:
+            logger.info("Deploying the certificate issued for {} by an earlier run".format(lead.name))
+            cert, pkey, cert_chain = pending
+            span.set('resumed', True)
+        else:
+            # Now that we're authorized to get certs for the domain(s), lets generate
+            # a private key and a csr, then use them to get a certificate
+            logger.info("Generate CSR and get cert for {}".format(", ".join(site.name for site in sites)))
+            with metrics.timer('keygen'), tracing.span('keygen'):
+                pkey, csr = AcmeCert.generate_csr(cfg.CERT_BITS, domains)
+            with metrics.timer('issue'), tracing.span('issue'):
+                cert, cert_chain = AcmeCert.get_cert(user, csr)
+            save_pending_cert(sites, domains, cert, pkey, cert_chain)
+
+        # With our certificate in hand we can update the site configuration
+        with tracing.span('deploy'):
+            results = deploy_group(sites, cert, pkey, cert_chain, elb_changes)
+        span.set('status', 'configured' if all(ok for site, ok in results) else 'failed')
+        return results
+
+
+def deploy_group(sites, cert, key, chain, elb_changes):
+    # One certificate for every site in sites, uploaded to IAM just once for
+    # all the sites that keep theirs there. Returns [(site, configured)].
+    results = []
+    uploaded = None
+    for site in sites:
+        if site.backend == 'iam' and uploaded is None:
+            certname = "{}_{}".format(site.id, strftime("%Y%m%d_%H%M%S", gmtime()))
+            with metrics.timer('deploy'):
+                uploaded = iam_upload_cert(certname, cert, key, chain)
+        results.append((site, configure_cert(site, cert, key, chain, elb_changes=elb_changes, uploaded=uploaded)))
+    return results
+
+
+def process_sites(context, due_sites, continuation, report):
     # get our user key to use with lets-encrypt
     user = get_user()
 
+    # the names each set of sites sharing a certificate needs it to have
+    planned = [(group, cert_domains(group)) for group in cert_groups(due_sites)]
+
+    # sites with a certificate from an earlier run that's still to be deployed
+    # don't need their domains authorized again
+    resuming = set(site.id for group, names in planned if has_pending_cert(group[0], names) for site in group)
+
     # validate domains
-    my_domains = []
-    for domain in cfg.DOMAINS:
+    wanted_domains = set(name for group, names in planned if group[0].id not in resuming for name in names)
+    # names we aren't authorized for(yet)
+    unauthorized = set()
+    http_pending = []
+    for name in sorted(wanted_domains):
+        domain = fleet.get_domain(name)
+        if domain is None:
+            logger.error("Domain {} isn't configured".format(name))
+            unauthorized.add(name)
+            continue
+        if not budget.has_time(AUTHORIZE_SECONDS):
+            continue_later(context, due_sites, continuation, report)
+            return
+
         # make sure cloudfront is configured properly for http-01 challenge validation
-        if 'http-01' in domain['VALIDATION_METHODS']:
+        if 'http-01' in domain.validation_methods:
             configure_cloudfront(domain, cfg.S3CHALLENGEBUCKET)
 
-        authzr = authorize_domain(user, domain)
-        if authzr:
-            my_domains.append(domain['DOMAIN'])
+        authzr = authorize_domain(user, domain, http_pending)
+        if not authzr:
+            unauthorized.add(domain.name)
 
-    for site in cfg.SITES:
-        if 'skip' in site:
-            continue
-        # check that we are authed for all the domains for this site
-        if not set(site['DOMAINS']).issubset(my_domains):
-            logger.info("Can't get cert for {}, still waiting on domain authorizations".format(site_name(site)))
+    if http_pending:
+        submit_http_challenges(http_pending)
+
+    ready = []
+    for group, names in planned:
+        # check that we are authed for all the names on the certificate
+        if group[0].id not in resuming and unauthorized.intersection(names):
+            for site in group:
+                logger.info("Can't get cert for {}, still waiting on domain authorizations".format(site.name))
+                report[site.id] = 'waiting'
             continue
+        ready.extend(group)
+
+    # one certificate for each set of sites with the same domains(or packed
+    # together, see packing.py)
+    groups = cert_groups(ready)
+    issued = 0
+    elb_changes = ElbCertChanges()
+    configured = []
+    for i, group in enumerate(groups):
+        if group[0].id not in resuming:
+            if max_issuances() is not None and issued >= max_issuances():
+                defer(group, report)
+                continue
+            issued += 1
+
+        if not budget.has_time(ISSUE_SECONDS):
+            apply_elb_changes(elb_changes, configured, report)
+            continue_later(context, [site for g in groups[i:] for site in g], continuation, report)
+            return
 
         try:
-            # Now that we're authorized to get certs for the domain(s), lets generate
-            # a private key and a csr, then use them to get a certificate
-            logger.info("Generate CSR and get cert for {}".format(site_name(site)))
-            pkey, csr = AcmeCert.generate_csr(cfg.CERT_BITS, site['DOMAINS'])
-            cert, cert_chain = AcmeCert.get_cert(user, csr)
-
-            # With our certificate in hand we can update the site configuration
-            ret = configure_cert(site, cert, pkey, cert_chain)
-            if ret:
-                notify_email("Certificate issued",
-                             "The certificate for {} has been successfully updated".format(site_name(site)))
-            else:
-                notify_email("Error issuing cert",
-                             "There was some sort of error configuring the site({}) with the certificate.".format(site_name(site)) +
-                             "Please review the logs in cloudwatch.")
+            for site, ok in issue_group(user, group, elb_changes):
+                if ok:
+                    configured.append(site)
+                else:
+                    report_configured(site, False, report)
         except Exception as e:
             logger.warning(e)
             raise
 
+    apply_elb_changes(elb_changes, configured, report)
+
+
+def save_result(event, result):
+    # A worker the coordinator didn't wait on leaves its result for it to collect
+    if event.get('result'):
+        save_file('letsencrypt', event['result'], json.dumps(result))
+    return result
+
+
+def wait_for_result(name):
+    # A worker's result, or None if it isn't there before we need the rest of
+    # our time to wrap up
+    while True:
+        result = load_file('letsencrypt', name)
+        if result is not False:
+            delete_file('letsencrypt', name)
+            return json.loads(result)
+        if not budget.has_time(RESULT_POLL_SECONDS + DISPATCH_SECONDS + CLEANUP_SECONDS):
+            return None
+        sleep(RESULT_POLL_SECONDS)
+
+
+def add_worker_results(results, report):
+    # The workers' statuses go in our report and their notifications out in
+    # our digest, the ones still running are left for a continuation. Returns
+    # the errors of the workers that failed.
+    aggregated = fanout.aggregate(results)
+    report.update(aggregated['sites'])
+    notifications.extend(aggregated.get('notifications', []))
+    workers.extend(aggregated.get('pending', []))
+    errors = aggregated.get('errors', [])
+    for error in errors:
+        notify_email("Worker failed", "A worker processing sites failed, its sites are reported as failed: {}".format(error),
+                     severity='error')
+    return errors
+
+
+def collect_workers(report):
+    # Results of the workers an earlier invocation didn't get to wait for,
+    # returns the errors of the ones that failed
+    if not workers:
+        return []
+    waiting = list(workers)
+    del workers[:]
+    results, not_started = fanout.fan_out(
+        lambda worker: wait_for_result(worker['result']) or {'pending': worker['result'], 'sites': worker['sites']},
+        waiting, max_concurrency=getattr(cfg, 'FANOUT_CONCURRENCY', 10)
+    )
+    return add_worker_results(results, report)
+
+
+@contextmanager
+def isolated_run():
+    # For in-process workers, which start a run of their own in our globals:
+    # puts our run(and its metrics, retries, trace) back afterwards
+    global budget, state, pending_state, notifications, workers
+    saved = (budget, state, pending_state, notifications, workers)
+    records = [(module, module.snapshot()) for module in (metrics, instrumentation, retry, tracing)]
+    try:
+        yield
+    finally:
+        budget, state, pending_state, notifications, workers = saved
+        for module, snapshot in records:
+            module.restore(snapshot)
+
+
+def coordinate(context, sites, continuation, report, expirations):
+    # Check expiry for every site here, then hand each due site(or set of sites
+    # sharing a certificate) to its own worker invocation so they're processed
+    # in parallel. Returns the errors of the workers that failed.
+    errors = collect_workers(report)
+    due_sites = find_due_sites(context, sites, continuation, report, expirations, mode='coordinator')
+    if due_sites is None:
+        return errors
+    if not due_sites:
+        if workers:
+            continue_later(context, [], continuation, report, mode='coordinator')
+        return errors
+
+    if context is not None and hasattr(context, 'invoked_function_arn'):
+        # workers run on their own clock, we only need the time to start them
+        dispatch = fanout.LambdaDispatcher(context.invoked_function_arn, lambda_c, wait_for_result)
+        concurrency = getattr(cfg, 'FANOUT_CONCURRENCY', 10)
+    else:
+        dispatch = fanout.LocalDispatcher(lambda_handler, isolate=isolated_run)
+        concurrency = 1
+
+    groups = cert_groups(due_sites)
+    if max_issuances() is not None:
+        defer([site for group in groups[max_issuances():] for site in group], report)
+        groups = groups[:max_issuances()]
+
+    # workers start from the saved state
+    save_state()
+    trace = tracing.context()
+    events = [{'sites': [site.id for site in group], 'due': True, 'trace': trace, 'notify': 'return'}
+              for group in groups]
+    if isinstance(dispatch, fanout.LambdaDispatcher):
+        for event in events:
+            event['result'] = 'result-{}.json'.format(uuid.uuid4().hex)
+    results, not_started = fanout.fan_out(
+        dispatch, events,
+        max_concurrency=concurrency,
+        should_continue=lambda: budget.has_time(DISPATCH_SECONDS + CLEANUP_SECONDS)
+    )
+    errors.extend(add_worker_results(results, report))
+
+    if not_started or workers:
+        not_started_ids = set(sid for event in not_started for sid in event['sites'])
+        remaining = [site for site in due_sites if site.id in not_started_ids]
+        continue_later(context, remaining, continuation, report, mode='coordinator')
+    return errors
+
+
+def set_schedule(when):
+    rule = getattr(cfg, 'SCHEDULE_RULE_NAME', None)
+    if not rule:
+        return
+    expression = scheduling.cron_expression(when)
+    logger.info("Scheduling next run for {} ({})".format(when.isoformat(), expression))
+    try:
+        events.put_rule(
+            Name=rule,
+            ScheduleExpression=expression,
+            State='ENABLED',
+            Description='Next Lambda Lets-Encrypt run, updated by every run'
+        )
+    except botocore.exceptions.ClientError as e:
+        logger.error("Unable to update schedule rule '{}'".format(rule))
+        logger.error(e)
+
+
+def schedule_retry():
+    # If this run dies part way through make sure we still run again soon
+    set_schedule(datetime.datetime.now(tz=tzutc()) +
+                 datetime.timedelta(hours=getattr(cfg, 'SCHEDULE_RETRY_HOURS', 4)))
+
+
+def is_scheduled_run(event):
+    # only the run started by the schedule decides when the next one happens
+    return not any(k in event for k in ('stage', 'site', 'sites', 'due', 'resume'))
+
+
+def schedule_next_run(expirations, report):
+    # include the sites that weren't looked at this run
+    known = fleet.expirations()
+    known.update(expirations)
+    set_schedule(scheduling.next_run(
+        known, report, site_renewal_days,
+        retry_hours=getattr(cfg, 'SCHEDULE_RETRY_HOURS', 4),
+        max_days=getattr(cfg, 'SCHEDULE_MAX_DAYS', 14)
+    ))
+
+
+def emit_metrics(context, **dimensions):
+    # Logs this run's metrics in embedded metric format and returns the summary
+    retries = retry.stats()
+    metrics.count('aws_calls', retries.get('aws', {}).get('attempts', 0))
+    metrics.count('retries', sum(s['retries'] for s in retries.values()))
+    # time spent backing off between attempts, all policies together
+    metrics.add_time('retry_wait', sum(s['wait_seconds'] for s in retries.values()))
+    namespace = getattr(cfg, 'METRICS_NAMESPACE', metrics.NAMESPACE)
+    if namespace:
+        dimensions['FunctionName'] = getattr(context, 'function_name', 'local')
+        metrics.emit(namespace, dimensions)
+    return metrics.summary()
+
+
+def log_aws_operations():
+    # Where this run spent its time talking to AWS, slowest operations first
+    rows = instrumentation.table()
+    if rows:
+        logger.info("AWS operations this run:\n{}".format(instrumentation.format_table(rows)))
+    return rows
+
+
+def lambda_handler(event, context):
+    global notifications
+    event = event or {}
+    # a digest of our own, so a warm container never sends(or hands the
+    # coordinator) what an earlier invocation left behind
+    digest = notifications = new_digest()
+    # carry on the trace of the invocation(or pipeline execution) that started us
+    tracing.reset(event.get('trace') or (event.get('state') or {}).get('trace'))
+    if is_scheduled_run(event):
+        # the schedule only fires once, so arm the retry before anything can
+        # fail or we'd never run again
+        schedule_retry()
+    try:
+        with tracing.span('invocation', stage=event.get('stage', 'run'), continuation=event.get('continuation', 0)):
+            if profiling.enabled(event):
+                return save_result(event, profile(event, context))
+            return save_result(event, handle(event, context))
+    except Exception as e:
+        if isinstance(e, AcmeError) and e.code in ACCOUNT_ERROR_CODES:
+            logger.warning("Lets-Encrypt rejected a request({}), will check the account next run".format(e.code))
+            invalidate_account()
+        if not event.get('result'):
+            raise
+        # the coordinator is waiting for this, and raising would only have
+        # lambda run the worker again
+        logger.exception(e)
+        return save_result(event, {'error': str(e), 'sites': event.get('sites', [])})
+    finally:
+        try:
+            save_state()
+        finally:
+            # a worker that returned has handed its notifications to the
+            # coordinator, anything left(e.g. it raised) is sent from here
+            send_notifications(digest)
+            tracing.flush()
+
+
+def profile(event, context):
+    # Profiled run, the stats are saved to the config bucket under the run id
+    run_id = getattr(context, 'aws_request_id', None) or str(uuid.uuid4())
+    logger.info("Profiling run {}".format(run_id))
+    result = profiling.run(
+        partial(save_file, profiling.PROFILE_DIR, run_id + '.prof'),
+        handle, event, context
+    )
+    if isinstance(result, dict) and 'stage' not in event:
+        result['profile'] = run_id
+    return result
+
+
+def handle(event, context):
+    global budget, state, pending_state, workers
+    budget = TimeBudget(context, reserve_seconds=getattr(cfg, 'TIME_RESERVE_SECONDS', 5))
+    state = new_state()
+    pending_state = new_pending_state()
+    workers = list((event or {}).get('workers', []))
+    iam_cache_clear()
+    retry.set_deadline(budget.deadline())
+    retry.reset_stats()
+    metrics.reset()
+    instrumentation.reset()
+    event = event or {}
+
+    # invoked as one stage of the step functions pipeline
+    if 'stage' in event:
+        import pipeline
+        load_fleet()
+        try:
+            return pipeline.handle_stage(event, context)
+        finally:
+            emit_metrics(context, Stage=event['stage'])
+            log_aws_operations()
+
+    # Do a few sanity checks
+    if not check_buckets():
+        return False
+    load_fleet()
+
+    report = {}
+    expirations = {}
+    sites = select_sites(event)
+    continuation = event.get('continuation', 0)
+
+    scheduled = is_scheduled_run(event)
+
+    mode = event.get('mode')
+    if mode is None:
+        is_worker = 'site' in event or 'sites' in event
+        mode = 'coordinator' if getattr(cfg, 'FANOUT', False) and not is_worker else 'worker'
+
+    errors = []
+    if mode == 'coordinator':
+        errors = coordinate(context, sites, continuation, report, expirations)
+    else:
+        if event.get('due'):
+            # the coordinator already checked these
+            due_sites = sites
+        else:
+            due_sites = find_due_sites(context, sites, continuation, report, expirations)
+        if due_sites:
+            process_sites(context, due_sites, continuation, report)
+
+    if scheduled and budget.has_time(CLEANUP_SECONDS):
+        with metrics.timer('cleanup'):
+            if getattr(cfg, 'DELETE_ORPHANED_CERTS', True):
+                collect_orphaned_certs(fleet.sites())
+            process_deletion_queue()
+
+    if scheduled:
+        schedule_next_run(expirations, report)
+
+    result = fanout.aggregate([{'sites': report, 'errors': errors}])
+    result['retries'] = retry.stats()
+    result['metrics'] = emit_metrics(context)
+    result['aws_operations'] = log_aws_operations()
+    if event.get('notify') == 'return':
+        # a worker, the coordinator sends these
+        result['notifications'] = notifications.take()
+    if expirations:
+        known = fleet.expirations()
+        known.update(expirations)
+        result['projected_load'] = renewal.projected_load(
+            known, tuple(getattr(cfg, 'RENEWAL_WINDOW_DAYS', renewal.DEFAULT_WINDOW)))
+        logger.info("Projected renewals per day: {}".format(json.dumps(result['projected_load'], sort_keys=True)))
+    return result
+
+
 # Support running directly for testing
 if __name__ == '__main__':
-    lambda_handler(None, None)
+    print(json.dumps(lambda_handler(None, None), indent=4))
@@ -0,0 +1,138 @@
+from __future__ import print_function
+import json
+import logging
+
+import retry
+
+logger = logging.getLogger("Lambda-LetsEncrypt")
+
+# What's kept in the manifest: the ACME account, the authorization for each
+# domain, per-site state(e.g. the SNI certificate deployed to an ELB) and the
+# expiration of each site's certificate(see registry.py)
+SECTIONS = ('account', 'authorizations', 'sites', 'expiry')
+
+# S3 error codes for a conditional write that lost a race with another writer
+CONFLICT_CODES = ('PreconditionFailed', 'ConditionalRequestConflict')
+
+_DELETED = object()
+
+
+class StateManifest:
+    """ All of the function's state in one object in the config bucket. It's
+    read with a single GET the first time something is needed, and written
+    back once(at the end of the run, or before handing off to another
+    invocation) only if something changed.
+
+    Writes are conditional on the ETag we read, so two invocations can't
+    overwrite each other: if someone else wrote in the meantime, their version
+    is reloaded, our changes are applied on top of it and the write is tried
+    again.
+
+    legacy_loader(section, key) is called for anything that isn't in the
+    manifest yet, so state from before the manifest existed(one file per
+    domain/site) is picked up and moved into it as it's used.
+
+    sections are the top-level keys it holds, a smaller manifest(e.g. for
+    state that has to be written straight away) can have different ones. """
+
+    def __init__(self, client, bucket, key, legacy_loader=None, max_attempts=5, sections=SECTIONS):
+        self.client = client
+        self.sections = sections
+        self.bucket = bucket
+        self.key = key
+        self.legacy_loader = legacy_loader
+        self.max_attempts = max_attempts
+        self.data = None
+        self.etag = None
+        self.changes = {}
+
+    def load(self):
+        try:
+            obj = self.client.get_object(Bucket=self.bucket, Key=self.key)
+        except Exception as e:
+            if retry.error_code(e) not in ('NoSuchKey', '404'):
+                raise
+            logger.info("No state manifest yet, starting a new one")
+            self.data = {'version': 0}
+            self.etag = None
+        else:
+            self.data = json.loads(obj['Body'].read().decode('utf-8'))
+            self.etag = obj['ETag']
+        for section in self.sections:
+            self.data.setdefault(section, {})
+        return self.data
+
+    def _loaded(self):
+        if self.data is None:
+            self.load()
+        return self.data
+
+    def section(self, section):
+        return self._loaded()[section]
+
+    def get(self, section, key, default=None):
+        data = self._loaded()
+        if key in data[section]:
+            return data[section][key]
+        if self.legacy_loader is not None:
+            value = self.legacy_loader(section, key)
+            if value is not None:
+                if value:
+                    logger.info("Moving {} state for '{}' into the manifest".format(section, key))
+                self.set(section, key, value)
+                return value
+        return default
+
+    def set(self, section, key, value):
+        data = self._loaded()
+        if data[section].get(key, _DELETED) == value:
+            return
+        data[section][key] = value
+        self.changes[(section, key)] = value
+
+    def delete(self, section, key):
+        data = self._loaded()
+        if key in data[section]:
+            del data[section][key]
+            self.changes[(section, key)] = _DELETED
+
+    def _apply_changes(self):
+        for (section, key), value in self.changes.items():
+            if value is _DELETED:
+                self.data[section].pop(key, None)
+            else:
+                self.data[section][key] = value
+
+    def save(self):
+        """ Writes the manifest if anything changed, returns True if it did """
+        if not self.changes:
+            return False
+
+        for attempt in range(self.max_attempts):
+            body = dict(self.data)
+            body['version'] = self.data.get('version', 0) + 1
+            args = {
+                'Bucket': self.bucket,
+                'Key': self.key,
+                'Body': json.dumps(body, sort_keys=True).encode('utf-8'),
+                'ContentType': 'application/json',
+            }
+            if self.etag:
+                args['IfMatch'] = self.etag
+            else:
+                args['IfNoneMatch'] = '*'
+            try:
+                resp = self.client.put_object(**args)
+            except Exception as e:
+                if retry.error_code(e) not in CONFLICT_CODES:
+                    raise
+                logger.info("State manifest was changed by another invocation, merging and retrying")
+                self.load()
+                self._apply_changes()
+                continue
+            self.data = body
+            self.etag = resp['ETag']
+            self.changes = {}
+            return True
+
+        raise IOError("Unable to save the state manifest after {} attempts".format(self.max_attempts))
@@ -0,0 +1,108 @@
+from __future__ import print_function
+import json
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+# CloudWatch namespace the metrics end up in
+NAMESPACE = 'LambdaLetsEncrypt'
+
+_lock = threading.Lock()
+_timers = {}
+_counters = {}
+
+
+def reset():
+    with _lock:
+        _timers.clear()
+        _counters.clear()
+
+
+def snapshot():
+    """ The timers and counters so far, for restore() """
+    with _lock:
+        return {'timers': dict(_timers), 'counters': dict(_counters)}
+
+
+def restore(saved):
+    with _lock:
+        _timers.clear()
+        _timers.update(saved['timers'])
+        _counters.clear()
+        _counters.update(saved['counters'])
+
+
+def add_time(name, seconds):
+    with _lock:
+        _timers[name] = _timers.get(name, 0.0) + seconds
+
+
+def count(name, amount=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+@contextmanager
+def timer(name):
+    """ Adds the time spent in the with block to the named stage timer. Stages
+    can nest(e.g. challenge solving happens during authorization), each timer
+    includes the time of the ones inside it. """
+    start = time.time()
+    try:
+        yield
+    finally:
+        add_time(name, time.time() - start)
+
+
+def timed(name):
+    """ Decorator version of timer() """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def summary():
+    """ Total milliseconds per stage and the counters, for the run result """
+    with _lock:
+        return {
+            'timers_ms': dict((name, int(seconds * 1000)) for name, seconds in _timers.items()),
+            'counters': dict(_counters),
+        }
+
+
+def _unit(name):
+    return 'Bytes' if name.endswith('_bytes') else 'Count'
+
+
+def emf(namespace=NAMESPACE, dimensions=None, timestamp=None):
+    """ The metrics as a CloudWatch Embedded Metric Format document. Written to
+    the log it gets turned into CloudWatch metrics without any API calls. """
+    dimensions = dimensions or {}
+    run = summary()
+    doc = dict(dimensions)
+    definitions = []
+    for name, ms in run['timers_ms'].items():
+        doc[name + '_ms'] = ms
+        definitions.append({'Name': name + '_ms', 'Unit': 'Milliseconds'})
+    for name, value in run['counters'].items():
+        doc[name] = value
+        definitions.append({'Name': name, 'Unit': _unit(name)})
+    doc['_aws'] = {
+        'Timestamp': int((timestamp or time.time()) * 1000),
+        'CloudWatchMetrics': [{
+            'Namespace': namespace,
+            'Dimensions': [sorted(dimensions.keys())],
+            'Metrics': definitions,
+        }]
+    }
+    return doc
+
+
+def emit(namespace=NAMESPACE, dimensions=None):
+    # Lambda sends stdout to CloudWatch logs, which picks the metrics out of it
+    print(json.dumps(emf(namespace, dimensions)))
@@ -0,0 +1,152 @@
+from __future__ import print_function
+
+# Kinds of site
+CLOUDFRONT = 'cloudfront'
+ELB = 'elb'
+
+VALIDATION_METHODS = ('http-01', 'dns-01')
+CERT_BACKENDS = ('iam', 'acm')
+
+# There are only a few combinations of validation methods, every domain with
+# the same ones shares a set
+_method_sets = {}
+
+
+class Domain(object):
+    """ A domain from DOMAINS, and how to prove we control it. Without a
+    route53_zone_id, dns-01 finds the hosted zone itself(see zones.py). """
+
+    __slots__ = ('name', 'validation_methods', 'cloudfront_id', 'route53_zone_id')
+
+    def __init__(self, name, validation_methods, cloudfront_id=None, route53_zone_id=None):
+        self.name = name
+        methods = frozenset(validation_methods)
+        self.validation_methods = _method_sets.setdefault(methods, methods)
+        self.cloudfront_id = cloudfront_id
+        self.route53_zone_id = route53_zone_id
+
+    @classmethod
+    def from_config(cls, data):
+        name = data.get('DOMAIN')
+        if not name:
+            raise ValueError("Domain without a DOMAIN: {}".format(data))
+        methods = data.get('VALIDATION_METHODS') or []
+        unknown = set(methods) - set(VALIDATION_METHODS)
+        if not methods or unknown:
+            raise ValueError("Domain {} needs VALIDATION_METHODS from {}".format(name, ", ".join(VALIDATION_METHODS)))
+        if is_wildcard(name):
+            # simple_acme speaks ACME v1, where Lets-Encrypt never issued wildcards
+            raise ValueError("Wildcard domain {} can't be issued with ACME v1".format(name))
+        if 'http-01' in methods and not data.get('CLOUDFRONT_ID'):
+            raise ValueError("Domain {} uses http-01 but has no CLOUDFRONT_ID".format(name))
+        return cls(name, methods, data.get('CLOUDFRONT_ID'), data.get('ROUTE53_ZONE_ID'))
+
+    def to_config(self):
+        data = {'DOMAIN': self.name, 'VALIDATION_METHODS': sorted(self.validation_methods)}
+        if self.cloudfront_id:
+            data['CLOUDFRONT_ID'] = self.cloudfront_id
+        if self.route53_zone_id:
+            data['ROUTE53_ZONE_ID'] = self.route53_zone_id
+        return data
+
+
+class Site(object):
+    """ A CloudFront distribution or ELB from SITES and the domains on its
+    certificate. Everything derived from the config(id, name, ports...) is
+    worked out once here rather than every time it's needed. """
+
+    __slots__ = ('kind', 'id', 'name', 'domains', 'domain_set', 'domain_key', 'backend', 'pinned',
+                 'cloudfront_id', 'elb_name', 'elb_ports', 'elb_sni')
+
+    def __init__(self, domains, cloudfront_id=None, elb_name=None, elb_ports=(443,), elb_sni=False, backend='iam',
+                 pinned=False):
+        self.domains = tuple(domains)
+        self.domain_set = frozenset(domains)
+        # sites with the same key can share a certificate
+        self.domain_key = frozenset(d.lower().rstrip('.') for d in domains)
+        self.backend = backend
+        # never shares a certificate with other sites(see packing.py)
+        self.pinned = pinned
+        self.cloudfront_id = cloudfront_id
+        self.elb_name = elb_name
+        self.elb_ports = tuple(elb_ports)
+        self.elb_sni = elb_sni
+        if cloudfront_id:
+            self.kind = CLOUDFRONT
+            self.id = "cfd-{}".format(cloudfront_id)
+            self.name = "CloudFront Distribution '{}'".format(cloudfront_id)
+        elif elb_sni:
+            # several SNI sites can share a load balancer, tell them apart by domain
+            self.kind = ELB
+            self.id = 'elb-{}-{}'.format(elb_name, self.domains[0].rstrip('.').replace('*', 'wildcard'))
+            self.name = "ELB Name '{}' ({})".format(elb_name, self.domains[0])
+        else:
+            self.kind = ELB
+            self.id = 'elb-{}'.format(elb_name)
+            self.name = "ELB Name '{}'".format(elb_name)
+
+    @classmethod
+    def from_config(cls, data):
+        domains = data.get('DOMAINS') or []
+        if not domains:
+            raise ValueError("Site without any DOMAINS: {}".format(data))
+        wildcards = [d for d in domains if is_wildcard(d)]
+        if wildcards:
+            raise ValueError("Wildcard domain {} can't be issued with ACME v1".format(wildcards[0]))
+        if ('CLOUDFRONT_ID' in data) == ('ELB_NAME' in data):
+            raise ValueError("Site for {} needs either a CLOUDFRONT_ID or an ELB_NAME".format(", ".join(domains)))
+        backend = data.get('CERT_BACKEND', 'iam')
+        if backend not in CERT_BACKENDS:
+            raise ValueError("Unknown CERT_BACKEND '{}' for {}".format(backend, ", ".join(domains)))
+        # ELB_PORT can be a single port or a list of them
+        ports = data.get('ELB_PORT', 443)
+        if not isinstance(ports, (list, tuple)):
+            ports = [ports]
+        return cls(domains, cloudfront_id=data.get('CLOUDFRONT_ID'), elb_name=data.get('ELB_NAME'),
+                   elb_ports=[int(p) for p in ports], elb_sni=bool(data.get('ELB_SNI', False)), backend=backend,
+                   pinned=bool(data.get('PIN_CERT', False)))
+
+    def to_config(self):
+        data = {'DOMAINS': list(self.domains)}
+        if self.kind == CLOUDFRONT:
+            data['CLOUDFRONT_ID'] = self.cloudfront_id
+        else:
+            data['ELB_NAME'] = self.elb_name
+            data['ELB_PORT'] = list(self.elb_ports) if len(self.elb_ports) > 1 else self.elb_ports[0]
+            if self.elb_sni:
+                data['ELB_SNI'] = True
+        if self.backend != 'iam':
+            data['CERT_BACKEND'] = self.backend
+        if self.pinned:
+            data['PIN_CERT'] = True
+        return data
+
+    def __repr__(self):
+        return "<Site {}>".format(self.id)
+
+
+def is_wildcard(name):
+    return name.startswith('*.')
+
+
+def group_by_domains(sites):
+    """ The sites as lists of sites with the same domains(e.g. a CloudFront
+    distribution and an ELB serving the same hostnames), which can share one
+    certificate. Groups are in the order of their first site. """
+    groups = {}
+    ordered = []
+    for site in sites:
+        if site.domain_key not in groups:
+            groups[site.domain_key] = []
+            ordered.append(groups[site.domain_key])
+        groups[site.domain_key].append(site)
+    return ordered
+
+
+def sites_by_domain(sites):
+    """ {domain name: [ids of the sites with it on their certificate]} """
+    index = {}
+    for site in sites:
+        for name in site.domains:
+            index.setdefault(name, []).append(site.id)
+    return index
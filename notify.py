@@ -0,0 +1,86 @@
+from __future__ import print_function
+import logging
+
+logger = logging.getLogger("Lambda-LetsEncrypt")
+
+# Most severe first, the digest lists them in this order
+SEVERITIES = ('critical', 'error', 'warning', 'info')
+
+# Largest digest to send(bytes), SNS takes up to 256KB but that's a long email
+MAX_BYTES = 64 * 1024
+# SNS subjects can't be longer than this
+MAX_SUBJECT = 100
+# Ends a digest that was cut off
+TRUNCATED = "... and {} more, see the logs in cloudwatch"
+
+
+class Digest:
+    """ The notifications for one run, sent as a single message at the end
+    rather than one per certificate. Entries are (severity, subject, message)
+    lists, so workers can hand theirs back to the coordinator in their
+    result(see fanout.aggregate). """
+
+    def __init__(self, max_bytes=MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = []
+
+    def add(self, severity, subject, message):
+        if severity not in SEVERITIES:
+            raise ValueError("Unknown notification severity '{}'".format(severity))
+        self.entries.append([severity, subject, message])
+
+    def extend(self, entries):
+        for severity, subject, message in entries:
+            self.add(severity, subject, message)
+
+    def take(self):
+        entries = self.entries
+        self.entries = []
+        return entries
+
+    def counts(self):
+        counts = {}
+        for severity, subject, message in self.entries:
+            counts[severity] = counts.get(severity, 0) + 1
+        return counts
+
+    def subject(self):
+        if len(self.entries) == 1:
+            return self.entries[0][1][:MAX_SUBJECT]
+        counts = self.counts()
+        parts = ["{} {}".format(counts[s], s) for s in SEVERITIES if s in counts]
+        return "{} notifications({})".format(len(self.entries), ", ".join(parts))[:MAX_SUBJECT]
+
+    def render(self):
+        """ The digest message: entries grouped by severity, then by subject
+        (e.g. every "Certificate issued" together), cut off at max_bytes """
+        if len(self.entries) == 1:
+            return self.entries[0][2]
+        lines = []
+        size = 0
+        left = len(self.entries)
+        for severity in SEVERITIES:
+            groups = {}
+            ordered = []
+            for entry in self.entries:
+                if entry[0] != severity:
+                    continue
+                if entry[1] not in groups:
+                    groups[entry[1]] = []
+                    ordered.append(entry[1])
+                groups[entry[1]].append(entry[2].strip())
+            for subject in ordered:
+                block = ["", "[{}] {}({})".format(severity.upper(), subject, len(groups[subject]))]
+                size += len(block[1]) + 2
+                for message in groups[subject]:
+                    line = "  - " + message.replace("\n", "\n    ")
+                    if size + len(line) + len(TRUNCATED) + 10 > self.max_bytes:
+                        lines.extend(block)
+                        lines.append("")
+                        lines.append(TRUNCATED.format(left))
+                        return "\n".join(lines).strip()
+                    block.append(line)
+                    size += len(line) + 1
+                    left -= 1
+                lines.extend(block)
+        return "\n".join(lines).strip()
@@ -0,0 +1,71 @@
+from __future__ import print_function
+
+import model
+
+# Lets-Encrypt's limit on the names in one certificate
+MAX_NAMES = 100
+
+
+def compatibility(site):
+    """ Sites can only share a certificate that's stored in the same place.
+    IAM certificates work for CloudFront and ELB alike, ACM ones are imported
+    per region(us-east-1 for CloudFront). """
+    if site.backend == 'acm':
+        return ('acm', site.kind)
+    return (site.backend,)
+
+
+def pack(sites, max_names=MAX_NAMES):
+    """ Splits sites into packs that can share one certificate(of at most
+    max_names names), trying to keep the number of packs small. It's a greedy
+    set cover: sites with the most names go first, each into the pack it
+    shares the most names with that still has room for the rest of its names,
+    otherwise into the latest pack with room, otherwise a new pack. Sites with
+    the same domains always end up together, pinned sites(PIN_CERT) always on
+    their own. Returns lists of site ids. """
+    packs = []
+    # pack indexes by name and by compatibility, to find candidates quickly
+    packs_by_name = {}
+    latest = {}
+
+    def new_pack(key, pinned=False):
+        packs.append({'key': key, 'names': set(), 'sites': [], 'pinned': pinned})
+        return len(packs) - 1
+
+    def add(i, names, ids):
+        packs[i]['sites'].extend(ids)
+        for name in names - packs[i]['names']:
+            packs_by_name.setdefault(name, []).append(i)
+        packs[i]['names'].update(names)
+
+    groups = model.group_by_domains(sorted(sites, key=lambda site: site.id))
+    groups.sort(key=lambda group: (-len(group[0].domain_key), group[0].id))
+    for group in groups:
+        names = group[0].domain_key
+        key = compatibility(group[0])
+        for site in [site for site in group if site.pinned]:
+            add(new_pack(key, pinned=True), names, [site.id])
+        ids = [site.id for site in group if not site.pinned]
+        if not ids:
+            continue
+
+        candidates = set(i for name in names for i in packs_by_name.get(name, ()))
+        if key in latest:
+            candidates.add(latest[key])
+        best = None
+        best_added = None
+        for i in sorted(candidates):
+            if packs[i]['key'] != key or packs[i]['pinned']:
+                continue
+            added = len(names - packs[i]['names'])
+            if len(packs[i]['names']) + added > max_names:
+                continue
+            if best is None or added < best_added:
+                best = i
+                best_added = added
+        if best is None:
+            best = new_pack(key)
+            latest[key] = best
+        add(best, names, ids)
+
+    return [p['sites'] for p in packs]
@@ -0,0 +1,206 @@
+from __future__ import print_function
+import json
+import logging
+
+from simple_acme import AcmeCert
+import lambda_function as lf
+import metrics
+import tracing
+import config as cfg
+
+logger = logging.getLogger("Lambda-LetsEncrypt")
+
+
+def sites_for(ids):
+    return [lf.fleet.get_site(sid) for sid in ids if lf.fleet.get_site(sid) is not None]
+
+
+# Each stage takes the state produced by the previous one and returns the
+# state for the next. See installer/stepfunctions.py for how they're wired up.
+@metrics.timed('plan')
+def plan_handler(state, context):
+    if not lf.check_buckets():
+        return {'sites': [], 'has_work': False}
+    due = [site for site in lf.sites_due_soon() if lf.is_domain_expiring(site)]
+    sites = [site.id for site in lf.with_siblings(due, {})]
+    # later stages add their spans to this trace, so the execution is one waterfall
+    trace = {'trace_id': tracing.context()['trace_id']}
+    return {'sites': sites, 'has_work': len(sites) > 0, 'attempts': 0, 'trace': trace}
+
+
+def _authorize(state, configure_challenges):
+    sites = sites_for(state['sites'])
+    wanted_domains = set(name for group in lf.cert_groups(sites) for name in lf.cert_domains(group))
+    # domains an earlier stage ran out of time before getting to
+    unstarted = set(state.get('unstarted_domains', []))
+
+    user = lf.get_user()
+    valid = []
+    pending = []
+    not_reached = []
+    http_pending = []
+    for name in sorted(wanted_domains):
+        domain = lf.fleet.get_domain(name)
+        if domain is None:
+            logger.error("Domain {} isn't configured".format(name))
+            continue
+        if not lf.budget.has_time(lf.AUTHORIZE_SECONDS):
+            # left pending, the next await-validation stage gets to it
+            pending.append(name)
+            not_reached.append(name)
+            continue
+        if (configure_challenges or name in unstarted) and 'http-01' in domain.validation_methods:
+            lf.configure_cloudfront(domain, cfg.S3CHALLENGEBUCKET)
+        if lf.authorize_domain(user, domain, http_pending):
+            valid.append(domain.name)
+        else:
+            pending.append(domain.name)
+
+    if http_pending:
+        lf.submit_http_challenges(http_pending)
+    if not_reached:
+        logger.info("Out of time, {} domain(s) left to authorize in the next stage".format(len(not_reached)))
+
+    state = dict(state)
+    state['valid_domains'] = valid
+    state['pending_domains'] = pending
+    state['unstarted_domains'] = [name for name in not_reached if configure_challenges or name in unstarted]
+    state['ready'] = len(pending) == 0
+    return state
+
+
+def authorize_handler(state, context):
+    return _authorize(state, configure_challenges=True)
+
+
+def await_validation_handler(state, context):
+    state = _authorize(state, configure_challenges=False)
+    state['attempts'] = state.get('attempts', 0) + 1
+    return state
+
+
+def issue_handler(state, context):
+    user = lf.get_user()
+    valid_domains = set(state.get('valid_domains', []))
+    issued = []
+    deferred = []
+    failed = []
+    count = 0
+    # sites with the same domains(or packed together) share a certificate
+    for group in lf.cert_groups(sites_for(state['sites'])):
+        lead = group[0]
+        domains = lf.cert_domains(group)
+        # issued certificates wait in the config bucket(see lf.save_pending_cert)
+        # rather than in the state, so the private key never ends up in the
+        # execution history
+        if lf.has_pending_cert(lead, domains):
+            logger.info("Certificate for {} was already issued, deploying it".format(lead.name))
+            issued.extend(site.id for site in group)
+            continue
+        if not valid_domains.issuperset(domains):
+            logger.info("Can't get cert for {}, still waiting on domain authorizations".format(lead.name))
+            continue
+        # whatever isn't issued now is due again next run
+        if lf.max_issuances() is not None and count >= lf.max_issuances():
+            lf.defer(group, {})
+            deferred.extend(site.id for site in group)
+            continue
+        if not lf.budget.has_time(lf.ISSUE_SECONDS):
+            logger.info("Out of time, leaving {} for the next run".format(lead.name))
+            deferred.extend(site.id for site in group)
+            continue
+        count += 1
+        logger.info("Generate CSR and get cert for {}".format(", ".join(site.name for site in group)))
+        try:
+            with metrics.timer('keygen'), tracing.span('keygen', site_id=lead.id):
+                pkey, csr = AcmeCert.generate_csr(cfg.CERT_BITS, domains)
+            with metrics.timer('issue'), tracing.span('issue', site_id=lead.id):
+                cert, cert_chain = AcmeCert.get_cert(user, csr)
+        except Exception as e:
+            # the other groups still get their certificates
+            logger.error("Unable to get a certificate for {}: {}".format(lead.name, e))
+            for site in group:
+                failed.append(site.id)
+                lf.report_configured(site, False, {})
+            continue
+        lf.save_pending_cert(group, domains, cert, pkey, cert_chain)
+        issued.extend(site.id for site in group)
+
+    state = dict(state)
+    state['issued'] = issued
+    state['deferred'] = deferred
+    state['failed'] = failed
+    return state
+
+
+def deploy_handler(state, context):
+    deployed = []
+    deferred = list(state.get('deferred', []))
+    # including the ones the issue stage couldn't get a certificate for
+    failed = list(state.get('failed', []))
+    configured = []
+    elb_changes = lf.ElbCertChanges()
+    for group in lf.cert_groups(sites_for(state.get('issued', []))):
+        if not lf.budget.has_time(lf.DEPLOY_SECONDS):
+            # the certificate waits in the config bucket for the next run
+            logger.info("Out of time, leaving {} to deploy next run".format(group[0].name))
+            deferred.extend(site.id for site in group)
+            continue
+        pending = lf.load_pending_cert(group[0], lf.cert_domains(group))
+        if pending is None:
+            logger.error("No issued certificate found for {}".format(group[0].name))
+            failed.extend(site.id for site in group)
+            continue
+        cert, key, chain = pending
+        for site, ok in lf.deploy_group(group, cert, key, chain, elb_changes):
+            if ok:
+                configured.append(site)
+            else:
+                failed.append(site.id)
+                lf.report_configured(site, False, {})
+
+    with metrics.timer('deploy'):
+        elb_failed = elb_changes.apply()
+    for site in configured:
+        ok = site.id not in elb_failed
+        if ok:
+            deployed.append(site.id)
+        else:
+            failed.append(site.id)
+        lf.report_configured(site, ok, {})
+
+    if lf.budget.has_time(lf.CLEANUP_SECONDS):
+        with metrics.timer('cleanup'):
+            lf.process_deletion_queue()
+
+    state = dict(state)
+    state['deployed'] = deployed
+    state['deferred'] = deferred
+    state['failed'] = failed
+    return state
+
+
+STAGES = {
+    'plan': plan_handler,
+    'authorize': authorize_handler,
+    'await-validation': await_validation_handler,
+    'issue': issue_handler,
+    'deploy': deploy_handler,
+}
+
+
+def handle_stage(event, context):
+    """ Entry point used by the state machine, event is {'stage': ..., 'state': {...}} """
+    stage = event['stage']
+    if stage not in STAGES:
+        raise ValueError("Unknown pipeline stage '{}'".format(stage))
+    logger.info("Running pipeline stage '{}'".format(stage))
+    return STAGES[stage](event.get('state') or {}, context)
+
+
+# Support running the whole pipeline locally for testing
+if __name__ == '__main__':
+    from installer.stepfunctions import LocalStateMachine, generate_definition
+    # through lambda_handler, so each stage gets set up like it would in lambda
+    machine = LocalStateMachine(generate_definition('local'), lf.lambda_handler, wait=True)
+    print(json.dumps(machine.run(), indent=4))
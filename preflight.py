@@ -0,0 +1,123 @@
+from __future__ import print_function
+import logging
+import socket
+import threading
+import time
+
+try:
+    # For Python 3.0 and later
+    from http.client import HTTPConnection, HTTPException
+    from queue import Queue, Empty
+except ImportError:
+    # Fall back to Python 2's httplib
+    from httplib import HTTPConnection, HTTPException
+    from Queue import Queue, Empty
+
+logger = logging.getLogger("Lambda-LetsEncrypt")
+
+# Seconds to wait before each round of checks. A freshly added challenge
+# origin/behavior can take a little while to show up on every CloudFront edge.
+DEFAULT_SCHEDULE = (0, 3, 7)
+DEFAULT_TIMEOUT = 3
+DEFAULT_WORKERS = 8
+
+
+def challenge_path(token):
+    return "/.well-known/acme-challenge/{}".format(token)
+
+
+def _response_matches(body, keyauth):
+    if isinstance(body, bytes):
+        body = body.decode('utf-8', 'replace')
+    return body.strip() == keyauth
+
+
+def _check_host(host, tokens, timeout, schedule, deadline, results):
+    # All the tokens for a host go over a single keep-alive connection
+    conn = None
+    pending = list(tokens)
+    for delay in schedule:
+        if not pending:
+            break
+        if deadline is not None and time.time() + delay > deadline:
+            logger.info("Out of time checking http-01 responses for {}".format(host))
+            break
+        if delay:
+            time.sleep(delay)
+
+        retry = []
+        for token, keyauth in pending:
+            if conn is None:
+                conn = HTTPConnection(host, timeout=timeout)
+            try:
+                conn.request('GET', challenge_path(token))
+                response = conn.getresponse()
+                body = response.read()
+            except (HTTPException, socket.error, IOError) as e:
+                logger.debug("Error fetching challenge {} from {}: {}".format(token, host, e))
+                conn.close()
+                conn = None
+                retry.append((token, keyauth))
+                continue
+
+            if response.getheader('connection', '').lower() == 'close':
+                conn.close()
+                conn = None
+
+            if response.status != 200:
+                logger.debug("HTTP code {} returned for {} on {}, expected 200".format(response.status, token, host))
+                retry.append((token, keyauth))
+            elif not _response_matches(body, keyauth):
+                logger.debug("Validation body for {} on {} didn't match yet".format(token, host))
+                retry.append((token, keyauth))
+            else:
+                results[(host, token)] = True
+        pending = retry
+
+    if conn is not None:
+        conn.close()
+    for token, keyauth in pending:
+        results[(host, token)] = False
+
+
+def check_http_tokens(tokens, timeout=DEFAULT_TIMEOUT, schedule=DEFAULT_SCHEDULE, max_workers=DEFAULT_WORKERS,
+                      deadline=None):
+    """ Checks that every (domain, token, keyauth) in tokens is being served
+    for http-01 validation. Hosts are checked concurrently; returns a dict of
+    domain -> True if all of that domain's tokens were reachable. """
+    by_host = {}
+    for domain, token, keyauth in tokens:
+        by_host.setdefault(domain, []).append((token, keyauth))
+    if not by_host:
+        return {}
+
+    work = Queue()
+    for host, host_tokens in by_host.items():
+        work.put((host, host_tokens))
+
+    results = {}
+
+    def worker():
+        while True:
+            try:
+                host, host_tokens = work.get_nowait()
+            except Empty:
+                return
+            try:
+                _check_host(host, host_tokens, timeout, schedule, deadline, results)
+            except Exception as e:
+                logger.warn("Unexpected error checking http-01 responses for {}: {}".format(host, e))
+                for token, keyauth in host_tokens:
+                    results[(host, token)] = False
+
+    threads = [threading.Thread(target=worker) for _ in range(min(max_workers, len(by_host)))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+
+    readiness = {}
+    for host, host_tokens in by_host.items():
+        readiness[host] = all(results.get((host, token), False) for token, keyauth in host_tokens)
+    return readiness
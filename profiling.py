@@ -0,0 +1,92 @@
+from __future__ import print_function
+import cProfile
+import logging
+import os
+import pstats
+import tempfile
+
+try:
+    # For Python 2, pstats writes byte strings
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+logger = logging.getLogger("Lambda-LetsEncrypt")
+
+# "Directory" in the config bucket the stats of profiled runs are saved in
+PROFILE_DIR = 'profiles'
+# Setting this environment variable on the function profiles every run
+ENV_VAR = 'LETSENCRYPT_PROFILE'
+
+
+def enabled(event):
+    """ Profile this run? Either {"profile": true} in the event or the environment variable """
+    if event.get('profile'):
+        return True
+    return os.environ.get(ENV_VAR, '').lower() in ('1', 'true', 'yes')
+
+
+def run(save, func, *args, **kwargs):
+    """ Runs func under cProfile and passes the stats(in pstats' file format)
+    to save, even if func raised. Only the calling thread is profiled, so time
+    spent in worker threads or openssl subprocesses shows up as time waiting
+    on them. """
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, *args, **kwargs)
+    finally:
+        try:
+            save(dump(profiler))
+        except Exception as e:
+            logger.error("Unable to save profile: {}".format(e))
+
+
+def dump(profiler):
+    fd, path = tempfile.mkstemp(suffix='.prof')
+    os.close(fd)
+    try:
+        pstats.Stats(profiler).dump_stats(path)
+        with open(path, 'rb') as f:
+            return f.read()
+    finally:
+        os.remove(path)
+
+
+def load(data):
+    """ pstats.Stats from the saved bytes """
+    fd, path = tempfile.mkstemp(suffix='.prof')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        return pstats.Stats(path)
+    finally:
+        os.remove(path)
+
+
+def summarize(data, sort='cumulative', limit=25):
+    """ The top functions of a profiled run as text """
+    out = StringIO()
+    stats = load(data)
+    stats.stream = out
+    stats.strip_dirs().sort_stats(sort).print_stats(limit)
+    return out.getvalue()
+
+
+def _cumulative(stats):
+    # {'file:line(function)': cumulative seconds}
+    return dict(("{}:{}({})".format(*func), value[3]) for func, value in stats.stats.items())
+
+
+def diff(data_a, data_b, limit=25):
+    """ The functions whose cumulative time changed the most between two runs, as text """
+    a = _cumulative(load(data_a).strip_dirs())
+    b = _cumulative(load(data_b).strip_dirs())
+    rows = []
+    for func in set(a) | set(b):
+        rows.append((func, a.get(func, 0.0), b.get(func, 0.0)))
+    rows.sort(key=lambda row: abs(row[2] - row[1]), reverse=True)
+
+    lines = ["{:>10}  {:>10}  {:>10}  {}".format('run a', 'run b', 'change', 'function')]
+    for func, time_a, time_b in rows[:limit]:
+        lines.append("{:10.3f}  {:10.3f}  {:+10.3f}  {}".format(time_a, time_b, time_b - time_a, func))
+    return "\n".join(lines)
@@ -0,0 +1,273 @@
+from __future__ import print_function
+import datetime
+import json
+import logging
+import sqlite3
+
+from dateutil.tz import tzutc
+
+import model
+import retry
+
+logger = logging.getLogger("Lambda-LetsEncrypt")
+
+# Number of sites handed out at once by due_sites()
+PAGE_SIZE = 100
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=tzutc())
+
+
+# Expirations are stored as seconds since the epoch, parsing thousands of
+# ISO dates every run adds up
+def to_timestamp(when):
+    return (when - EPOCH).total_seconds()
+
+
+def from_timestamp(ts):
+    return datetime.datetime.fromtimestamp(ts, tzutc())
+
+
+class ManifestIndex:
+    """ Expiration dates of the sites' current certificates, kept in the state
+    manifest(see manifest.py). state is a callable returning the current run's
+    StateManifest. """
+
+    SECTION = 'expiry'
+
+    def __init__(self, state):
+        self.state = state
+
+    def all(self):
+        return dict((sid, from_timestamp(ts)) for sid, ts in self.state().section(self.SECTION).items())
+
+    def set(self, site_id, expiration):
+        self.state().set(self.SECTION, site_id, to_timestamp(expiration))
+
+    def delete(self, site_id):
+        self.state().delete(self.SECTION, site_id)
+
+
+class Registry:
+    """ Where the sites and domains to manage come from. Subclasses load
+    them(as config dicts, see model.py), this validates them once, keeps them
+    indexed by id/name and keeps track of when each site's certificate
+    expires so runs only need to look at the sites that are nearly due. """
+
+    def __init__(self, index=None):
+        self.index = index
+        # changes whenever the sites/domains do
+        self.version = 0
+        self._sites = {}
+        self._domains = {}
+        self._sites_by_domain = {}
+
+    def _set(self, sites, domains):
+        self.version += 1
+        sites = [model.Site.from_config(site) for site in sites]
+        self._sites = dict((site.id, site) for site in sites)
+        self._domains = dict((domain.name, domain) for domain in (model.Domain.from_config(d) for d in domains))
+        self._sites_by_domain = model.sites_by_domain(sites)
+        missing = set(self._sites_by_domain) - set(self._domains)
+        if missing:
+            logger.error("Sites use domains that aren't configured, they won't get certificates: {}".format(
+                ", ".join(sorted(missing))))
+
+    def refresh(self):
+        """ Called at the start of every run, reloads the sites/domains if they changed """
+        pass
+
+    def sites(self):
+        return list(self._sites.values())
+
+    def domains(self):
+        return list(self._domains.values())
+
+    def get_site(self, site_id):
+        return self._sites.get(site_id)
+
+    def get_domain(self, name):
+        return self._domains.get(name)
+
+    def sites_for_domain(self, name):
+        """ The ids of the sites with name on their certificate """
+        return self._sites_by_domain.get(name, [])
+
+    def expirations(self):
+        """ {site id: expiration} for the sites we know the expiration of """
+        if self.index is None:
+            return {}
+        return dict((sid, when) for sid, when in self.index.all().items() if sid in self._sites)
+
+    def record_expiration(self, site_id, expiration):
+        if self.index is not None:
+            self.index.set(site_id, expiration)
+
+    def forget_expiration(self, site_id):
+        # e.g. after a new certificate is issued, so it gets looked at again
+        if self.index is not None:
+            self.index.delete(site_id)
+
+    def due_sites(self, until, renewal_days, page_size=PAGE_SIZE):
+        """ Pages of the sites that renew(renewal_days(site_id) days before
+        their expiration) before until. Sites with no known expiration come
+        first, then the rest in the order they're due. """
+        expirations = self.expirations()
+        unknown = [site for sid, site in sorted(self._sites.items()) if sid not in expirations]
+        due = []
+        for sid, expiration in expirations.items():
+            renew_at = expiration - datetime.timedelta(days=renewal_days(sid))
+            if renew_at <= until:
+                due.append((renew_at, sid))
+        ordered = unknown + [self._sites[sid] for renew_at, sid in sorted(due)]
+        for i in range(0, len(ordered), page_size):
+            yield ordered[i:i + page_size]
+
+
+class ConfigRegistry(Registry):
+    """ SITES and DOMAINS from config.py """
+
+    def __init__(self, cfg, index=None):
+        Registry.__init__(self, index)
+        self._set(cfg.SITES, cfg.DOMAINS)
+
+
+class S3Registry(Registry):
+    """ Sites and domains in an object in S3, so they can be changed without
+    uploading the function again. Either JSON({"SITES": [...], "DOMAINS": [...]},
+    like config.py) or, for keys ending in .jsonl, one site or domain per line
+    with a "type" of "site" or "domain". The object is only downloaded again
+    when its ETag changes, a warm container keeps the last copy. """
+
+    def __init__(self, client, bucket, key, index=None):
+        Registry.__init__(self, index)
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.etag = None
+
+    def refresh(self):
+        args = {'Bucket': self.bucket, 'Key': self.key}
+        if self.etag:
+            args['IfNoneMatch'] = self.etag
+        try:
+            obj = self.client.get_object(**args)
+        except Exception as e:
+            if retry.error_code(e) in ('304', 'NotModified'):
+                return False
+            raise
+        self._set(*self.parse(obj['Body'].read().decode('utf-8')))
+        self.etag = obj['ETag']
+        logger.info("Loaded {} sites and {} domains from s3://{}/{}".format(
+            len(self._sites), len(self._domains), self.bucket, self.key))
+        return True
+
+    def parse(self, text):
+        if not self.key.endswith('.jsonl'):
+            data = json.loads(text)
+            return data.get('SITES', []), data.get('DOMAINS', [])
+        sites = []
+        domains = []
+        for line in text.splitlines():
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            kind = record.pop('type')
+            if kind == 'site':
+                sites.append(record)
+            elif kind == 'domain':
+                domains.append(record)
+            else:
+                raise ValueError("Unknown registry record type '{}'".format(kind))
+        return sites, domains
+
+
+class SqliteRegistry(Registry):
+    """ Sites and domains in a SQLite database, with the expirations in the
+    same table so due sites are paged straight out of the database. Mostly
+    for testing and local tooling, Lambda has no persistent disk. """
+
+    def __init__(self, path):
+        Registry.__init__(self)
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS sites (id TEXT PRIMARY KEY, data TEXT, expiration REAL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS sites_expiration ON sites (expiration)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS domains (name TEXT PRIMARY KEY, data TEXT)")
+        self.db.commit()
+        self.refresh()
+
+    def refresh(self):
+        self._set([json.loads(row[0]) for row in self.db.execute("SELECT data FROM sites")],
+                  [json.loads(row[0]) for row in self.db.execute("SELECT data FROM domains")])
+
+    def add_site(self, data):
+        site = model.Site.from_config(data)
+        self.db.execute("INSERT OR REPLACE INTO sites (id, data, expiration) VALUES "
+                        "(?, ?, (SELECT expiration FROM sites WHERE id = ?))",
+                        (site.id, json.dumps(site.to_config()), site.id))
+        self.db.commit()
+        self.version += 1
+        old = self._sites.get(site.id)
+        for name in old.domains if old else ():
+            self._sites_by_domain[name].remove(site.id)
+        self._sites[site.id] = site
+        for name in site.domains:
+            self._sites_by_domain.setdefault(name, []).append(site.id)
+
+    def add_domain(self, data):
+        domain = model.Domain.from_config(data)
+        self.db.execute("INSERT OR REPLACE INTO domains (name, data) VALUES (?, ?)",
+                        (domain.name, json.dumps(domain.to_config())))
+        self.db.commit()
+        self.version += 1
+        self._domains[domain.name] = domain
+
+    def expirations(self):
+        rows = self.db.execute("SELECT id, expiration FROM sites WHERE expiration IS NOT NULL")
+        return dict((sid, from_timestamp(ts)) for sid, ts in rows)
+
+    def record_expiration(self, site_id, expiration):
+        self.db.execute("UPDATE sites SET expiration = ? WHERE id = ?", (to_timestamp(expiration), site_id))
+        self.db.commit()
+
+    def forget_expiration(self, site_id):
+        self.db.execute("UPDATE sites SET expiration = NULL WHERE id = ?", (site_id,))
+        self.db.commit()
+
+    def due_sites(self, until, renewal_days, page_size=PAGE_SIZE, max_renewal_days=365):
+        # Sites can renew up to max_renewal_days early, the database narrows it
+        # down to the sites that might be due and renewal_days does the rest
+        limit = until + datetime.timedelta(days=max_renewal_days)
+        limit_ts = to_timestamp(limit)
+        offset = 0
+        while True:
+            rows = self.db.execute(
+                "SELECT id, expiration FROM sites WHERE expiration IS NULL OR expiration <= ? "
+                "ORDER BY expiration IS NOT NULL, expiration, id LIMIT ? OFFSET ?",
+                (limit_ts, page_size, offset)).fetchall()
+            if not rows:
+                return
+            offset += len(rows)
+            page = []
+            for sid, ts in rows:
+                if ts is not None:
+                    renew_at = from_timestamp(ts) - datetime.timedelta(days=renewal_days(sid))
+                    if renew_at > until:
+                        continue
+                page.append(self._sites[sid])
+            if page:
+                yield page
+
+
+def from_config(cfg, s3_client, index=None):
+    """ The registry cfg.REGISTRY asks for, e.g. {'type': 's3', 'key': 'registry/sites.json'}
+    (in the config bucket unless 'bucket' is given) or {'type': 'sqlite', 'path': ...}.
+    Defaults to SITES and DOMAINS from the config itself. """
+    settings = getattr(cfg, 'REGISTRY', None) or {'type': 'config'}
+    kind = settings['type']
+    if kind == 'config':
+        return ConfigRegistry(cfg, index)
+    if kind == 's3':
+        return S3Registry(s3_client, settings.get('bucket', cfg.S3CONFIGBUCKET), settings['key'], index)
+    if kind == 'sqlite':
+        return SqliteRegistry(settings['path'])
+    raise ValueError("Unknown registry type '{}'".format(kind))
@@ -0,0 +1,36 @@
+from __future__ import print_function
+import datetime
+import hashlib
+
+# Default range of days-before-expiry that sites renew in
+DEFAULT_WINDOW = (20, 30)
+
+
+def renewal_days(site_id, window=DEFAULT_WINDOW):
+    """ The number of days before expiry that a site renews at. Derived from a
+    hash of the site id so it's stable between runs, but sites set up at the
+    same time get spread out over the window instead of all renewing at once. """
+    low, high = window
+    digest = int(hashlib.sha256(site_id.encode('utf-8')).hexdigest(), 16)
+    return low + digest % (high - low + 1)
+
+
+def renewal_date(site_id, expiration, window=DEFAULT_WINDOW):
+    return expiration - datetime.timedelta(days=renewal_days(site_id, window))
+
+
+def projected_load(expirations, window=DEFAULT_WINDOW):
+    """ Number of sites due to renew on each day, as {'YYYY-MM-DD': count} """
+    load = {}
+    for site_id, expiration in expirations.items():
+        day = renewal_date(site_id, expiration, window).strftime("%Y-%m-%d")
+        load[day] = load.get(day, 0) + 1
+    return load
+
+
+def by_urgency(sites, expirations, site_id):
+    """ Sites with no certificate first, then the ones expiring soonest """
+    def key(site):
+        expiration = expirations.get(site_id(site))
+        return (expiration is not None, expiration)
+    return sorted(sites, key=key)
@@ -0,0 +1,152 @@
+from __future__ import print_function
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger("Lambda-LetsEncrypt")
+
+# AWS error codes worth retrying for any call
+THROTTLING_CODES = frozenset([
+    'Throttling', 'ThrottlingException', 'ThrottledException', 'RequestLimitExceeded',
+    'TooManyRequestsException', 'RequestThrottled', 'RequestThrottledException',
+    'ProvisionedThroughputExceededException', 'SlowDown', 'PriorRequestNotComplete',
+])
+TRANSIENT_CODES = frozenset([
+    'InternalError', 'InternalFailure', 'InternalServiceError', 'ServiceUnavailable',
+    'RequestTimeout', 'RequestTimeoutException',
+])
+
+# Wall clock time(as time.time()) that no retry should wait past, set by the
+# lambda handler from the time left in the invocation
+deadline = None
+
+_stats_lock = threading.Lock()
+_stats = {}
+# the attempt each RetryPolicy.call running on this thread is on(they can nest)
+_local = threading.local()
+
+
+def set_deadline(when):
+    global deadline
+    deadline = when
+
+
+def error_code(e):
+    """ The error code of an AWS(botocore ClientError) or ACME(AcmeError) exception """
+    response = getattr(e, 'response', None)
+    if isinstance(response, dict):
+        return response.get('Error', {}).get('Code')
+    return getattr(e, 'code', None)
+
+
+def _record(name, field, amount=1):
+    with _stats_lock:
+        stats = _stats.setdefault(name, {'calls': 0, 'attempts': 0, 'retries': 0, 'wait_seconds': 0.0, 'gave_up': 0})
+        stats[field] += amount
+
+
+def stats():
+    """ Per-policy counts of calls, attempts made, retries, time spent waiting and calls that gave up """
+    with _stats_lock:
+        return dict((name, dict(s)) for name, s in _stats.items())
+
+
+def reset_stats():
+    with _stats_lock:
+        _stats.clear()
+
+
+def retrying():
+    """ Whether the call being made on this thread is a retry, by any of the
+    policies it's running under(see instrumentation) """
+    return any(attempt > 1 for attempt in getattr(_local, 'attempts', ()))
+
+
+def snapshot():
+    """ The deadline and stats so far, for restore() """
+    return {'deadline': deadline, 'stats': stats()}
+
+
+def restore(saved):
+    set_deadline(saved['deadline'])
+    with _stats_lock:
+        _stats.clear()
+        _stats.update(saved['stats'])
+
+
+class RetryPolicy:
+    """ Retries a call with exponential backoff and full jitter, for errors that
+    are retryable. Won't sleep past the module deadline. """
+
+    def __init__(self, name, max_attempts=5, base_delay=0.5, max_delay=20, retry_codes=(),
+                 retry_exceptions=(), retry_throttling=True):
+        self.name = name
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_codes = frozenset(retry_codes)
+        if retry_throttling:
+            self.retry_codes = self.retry_codes | THROTTLING_CODES | TRANSIENT_CODES
+        self.retry_exceptions = tuple(retry_exceptions)
+
+    def is_retryable(self, e):
+        if self.retry_exceptions and isinstance(e, self.retry_exceptions):
+            return True
+        return error_code(e) in self.retry_codes
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** (attempt - 1))))
+
+    def call(self, func, *args, **kwargs):
+        if not hasattr(_local, 'attempts'):
+            _local.attempts = []
+        _local.attempts.append(0)
+        try:
+            return self._call(func, *args, **kwargs)
+        finally:
+            _local.attempts.pop()
+
+    def _call(self, func, *args, **kwargs):
+        attempt = 0
+        _record(self.name, 'calls')
+        while True:
+            attempt += 1
+            _local.attempts[-1] = attempt
+            _record(self.name, 'attempts')
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                if not self.is_retryable(e):
+                    raise
+                if attempt >= self.max_attempts:
+                    _record(self.name, 'gave_up')
+                    raise
+                delay = self.delay(attempt)
+                if deadline is not None and time.time() + delay > deadline:
+                    logger.info("Out of time to retry {}: {}".format(self.name, e))
+                    _record(self.name, 'gave_up')
+                    raise
+                logger.info("Retrying {} in {:.1f}s after: {}".format(self.name, delay, e))
+                _record(self.name, 'retries')
+                _record(self.name, 'wait_seconds', delay)
+                time.sleep(delay)
+
+
+class RetryingClient:
+    """ Wraps a boto3 client so every API call goes through a RetryPolicy """
+
+    PASSTHROUGH = ('meta', 'exceptions', 'get_paginator', 'get_waiter', 'can_paginate')
+
+    def __init__(self, client, policy):
+        self._client = client
+        self._policy = policy
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if name in self.PASSTHROUGH or name.startswith('_') or not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            return self._policy.call(attr, *args, **kwargs)
+        return call
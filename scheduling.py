@@ -0,0 +1,35 @@
+from __future__ import print_function
+import datetime
+from dateutil.tz import tzutc
+
+# Statuses in a run report that mean there's still work to do for a site
+PENDING_STATUSES = ('waiting', 'continued', 'failed', 'deferred')
+
+# How long a freshly issued Lets-Encrypt certificate is valid for
+CERT_LIFETIME_DAYS = 90
+
+
+def next_run(expirations, report, renewal_days, retry_hours=4, max_days=14, min_minutes=30, now=None):
+    """ Works out when the function next needs to run: when the first site
+    enters its renewal window, or after retry_hours if some site still has
+    pending work. Never sooner than min_minutes or later than max_days.
+    renewal_days(site_id) gives the days before expiry a site renews at. """
+    now = now or datetime.datetime.now(tz=tzutc())
+    candidates = [now + datetime.timedelta(days=max_days)]
+
+    for site_id, status in report.items():
+        if status in PENDING_STATUSES:
+            candidates.append(now + datetime.timedelta(hours=retry_hours))
+        elif status == 'issued':
+            expiration = now + datetime.timedelta(days=CERT_LIFETIME_DAYS)
+            candidates.append(expiration - datetime.timedelta(days=renewal_days(site_id)))
+        elif site_id in expirations:
+            candidates.append(expirations[site_id] - datetime.timedelta(days=renewal_days(site_id)))
+
+    return max(min(candidates), now + datetime.timedelta(minutes=min_minutes))
+
+
+def cron_expression(when):
+    """ EventBridge schedule expression that fires once, at the given time(UTC) """
+    when = when.astimezone(tzutc())
+    return "cron({} {} {} {} ? {})".format(when.minute, when.hour, when.day, when.month, when.year)
@@ -10,7 +10,17 @@ import re
 import subprocess
 import tempfile
 import textwrap
-from urllib2 import urlopen
+import metrics
+import retry
+import tracing
+
+try:
+    # For Python 3.0 and later
+    from urllib.request import urlopen
+    from urllib.error import HTTPError, URLError
+except ImportError:
+    # Fall back to Python 2's urllib2
+    from urllib2 import urlopen, HTTPError, URLError
 
 # Configure logging
 logging.basicConfig(level=logging.ERROR)
@@ -20,6 +30,36 @@ logger.setLevel(logging.INFO)
 
 LE_NONCE = None
 
+# Signed requests(new-reg, new-authz, new-cert...) aren't safe to repeat if we
+# don't know whether the server saw them, so only errors the server answered
+# with are retried for those. Plain GETs are also retried on network errors.
+ACME_RETRY = retry.RetryPolicy('acme', retry_codes=['badNonce', 'serverInternal', 'serverError'],
+                               retry_throttling=False)
+ACME_GET_RETRY = retry.RetryPolicy('acme-get', retry_codes=['serverError'],
+                                   retry_exceptions=[URLError], retry_throttling=False)
+
+
+class AcmeError(IOError):
+    """ An error response from the ACME server. code is the ACME error type
+    (e.g. badNonce), or serverError for 5xx responses without one """
+
+    def __init__(self, message, status=None, code=None):
+        IOError.__init__(self, message)
+        self.status = status
+        self.code = code
+
+
+def _acme_error(e):
+    body = e.read()
+    code = None
+    try:
+        code = json.loads(body.decode('utf-8')).get('type', '').split(':')[-1] or None
+    except (ValueError, AttributeError):
+        pass
+    if code is None and e.code >= 500:
+        code = 'serverError'
+    return AcmeError("Unexpected response: {}".format(body), status=e.code, code=code)
+
 
 # from: https://github.com/diafygi/acme-tiny
 # helper function base64 encode for jose spec
@@ -29,21 +69,39 @@ def _b64(b):
 
 # helper functions for making (un)signed requests
 def _get_request(url):
-    try:
-        resp = urlopen(url)
-        return resp.getcode(), resp.read(), resp.info()
-    except IOError as e:
-        return e.getcode(), e.read(), e.info()
+    return ACME_GET_RETRY.call(_get_request_once, url)
+
+
+def _get_request_once(url):
+    metrics.count('acme_requests')
+    with tracing.span('acme.request', method='GET', url=url) as span:
+        try:
+            resp = urlopen(url)
+            body = resp.read()
+            metrics.count('acme_received_bytes', len(body))
+            span.set('status', resp.getcode())
+            span.set('bytes', len(body))
+            return resp.getcode(), body, resp.info()
+        except HTTPError as e:
+            span.set('status', e.code)
+            if e.code >= 500:
+                raise _acme_error(e)
+            return e.getcode(), e.read(), e.info()
 
 
 def _send_signed_request(user, url, payload):
+    return ACME_RETRY.call(_send_signed_request_once, user, url, payload)
+
+
+def _send_signed_request_once(user, url, payload):
     global LE_NONCE
     payload64 = _b64(json.dumps(payload).encode('utf8'))
     protected = copy.deepcopy(user.jws_header)
 
     # Get a Nonce if we don't have one
     if LE_NONCE is None:
-        LE_NONCE = urlopen(cfg.DIRECTORY_URL + "/directory").headers['Replay-Nonce']
+        metrics.count('acme_requests')
+        LE_NONCE = ACME_GET_RETRY.call(urlopen, cfg.DIRECTORY_URL + "/directory").info().get('Replay-Nonce')
     protected["nonce"] = LE_NONCE
     LE_NONCE = None  # Make sure we don't re-use a nonce
 
@@ -53,13 +111,21 @@ def _send_signed_request(user, url, payload):
         "header": user.jws_header, "protected": protected64,
         "payload": payload64, "signature": _b64(signature),
     })
-    try:
-        resp = urlopen(url, data.encode('utf8'))
-        LE_NONCE = resp.info().getheader('Replay-Nonce', None)
-        return resp.getcode(), resp.read(), resp.info()
-    except IOError as e:
-        LE_NONCE = e.info().getheader('Replay-Nonce', None)
-        raise IOError("Unexpected response: {}".format(e.read()))
+    metrics.count('acme_requests')
+    metrics.count('acme_sent_bytes', len(data))
+    with tracing.span('acme.request', method='POST', url=url, resource=payload.get('resource', '')) as span:
+        try:
+            resp = urlopen(url, data.encode('utf8'))
+            LE_NONCE = resp.info().get('Replay-Nonce', None)
+            body = resp.read()
+            metrics.count('acme_received_bytes', len(body))
+            span.set('status', resp.getcode())
+            span.set('bytes', len(body))
+            return resp.getcode(), body, resp.info()
+        except HTTPError as e:
+            LE_NONCE = e.info().get('Replay-Nonce', None)
+            span.set('status', e.code)
+            raise _acme_error(e)
 
 
 class AcmeUser:
@@ -175,8 +241,8 @@ class AcmeUser:
                         "mailto:{}".format(email)
                     ],
                 })
-            self.url = info.getheader('Location')
-            links = info.getheader('Link')
+            self.url = info.get('Location')
+            links = info.get('Link')
             if re.search(r';rel="terms-of-service"', links):
                 self.agreement = re.sub(r'.*<(.*)>;rel="terms-of-service".*', r'\1', links)
 
@@ -238,7 +304,7 @@ class AcmeAuthorization:
                     }
                 })
             # save the url of this authorization so we can check it later
-            self.url = info.getheader("Location")
+            self.url = info.get("Location")
 
         # get the data from our url
         code, result, info = _get_request(self.url)
@@ -255,8 +321,10 @@ class AcmeAuthorization:
                     logger.debug(c['error']['detail'])
         return status
 
-    def complete_challenges(self, challenge_type, func_challenge, func_verifier):
-        """ calls func_challenge to complete any challenges matching the desired type """
+    def solve_challenges(self, challenge_type, func_challenge):
+        """ calls func_challenge to set up any challenges matching the desired type,
+        returns a list of (challenge, key_authorization) that were set up """
+        solved = []
         challenges = [x for x in self.challenges if x['type'] == challenge_type]
         for challenge in challenges:
             token = challenge['token']
@@ -273,21 +341,29 @@ class AcmeAuthorization:
             if not ret:
                 logger.debug("Challenge completion handler failed...")
                 continue
+            solved.append((challenge, key_authorization))
+        return solved
+
+    def submit_challenge(self, challenge, key_authorization):
+        """ tells letsencrypt we finished the challenge """
+        code, result, info = _send_signed_request(
+            self.user,
+            challenge['uri'],
+            {
+                "resource": "challenge",
+                "keyAuthorization": key_authorization
+            })
+        return json.loads(result)
 
+    def complete_challenges(self, challenge_type, func_challenge, func_verifier):
+        """ calls func_challenge to complete any challenges matching the desired type """
+        for challenge, key_authorization in self.solve_challenges(challenge_type, func_challenge):
             # try to verify/validate it
-            ret = func_verifier(self.domain, token, key_authorization)
+            ret = func_verifier(self.domain, challenge['token'], key_authorization)
             if not ret:
                 logger.warn("Error checking validation for {}. Trying anyway.".format(self.domain))
 
-            # tell letsencrypt we finished the challenge
-            code, result, info = _send_signed_request(
-                self.user,
-                challenge['uri'],
-                {
-                    "resource": "challenge",
-                    "keyAuthorization": key_authorization
-                })
-            result = json.loads(result)
+            self.submit_challenge(challenge, key_authorization)
 
 
 class AcmeCert:
@@ -362,7 +438,7 @@ subjectAltName = @alt_names
         cert = "-----BEGIN CERTIFICATE-----\n{0}\n-----END CERTIFICATE-----\n".format(
                "\n".join(textwrap.wrap(base64.b64encode(result).decode('utf8'), 64)))
 
-        links = info.getheader('Link')
+        links = info.get('Link')
         if re.search(r';rel="up"', links):
             chain_cert_url = re.sub(r'.*<(.*)>;rel="up".*', r'\1', links)
             code, result, info = _get_request(chain_cert_url)
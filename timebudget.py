@@ -0,0 +1,31 @@
+from __future__ import print_function
+import time
+
+
+class TimeBudget:
+    """ Keeps track of how much of the Lambda invocation is left, so work can be
+    stopped (and handed off to another invocation) before we get killed. """
+
+    def __init__(self, context=None, reserve_seconds=5):
+        self.context = context
+        self.reserve_ms = int(reserve_seconds * 1000)
+        self.started = time.time()
+
+    def remaining_ms(self):
+        if self.context is None or not hasattr(self.context, 'get_remaining_time_in_millis'):
+            # not running in lambda(e.g. testing locally), no limit
+            return float('inf')
+        return self.context.get_remaining_time_in_millis()
+
+    def usable_ms(self):
+        return self.remaining_ms() - self.reserve_ms
+
+    def has_time(self, seconds=0):
+        return self.usable_ms() >= seconds * 1000
+
+    def deadline(self):
+        """ Wall clock time(as time.time()) after which we should stop starting new work """
+        usable = self.usable_ms()
+        if usable == float('inf'):
+            return None
+        return time.time() + usable / 1000.0
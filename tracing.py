@@ -0,0 +1,252 @@
+from __future__ import print_function
+import json
+import logging
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from functools import wraps
+
+try:
+    # For Python 3.0 and later
+    from urllib.request import urlopen, Request
+except ImportError:
+    # Fall back to Python 2's urllib2
+    from urllib2 import urlopen, Request
+
+logger = logging.getLogger("Lambda-LetsEncrypt")
+
+SERVICE_NAME = 'lambda-letsencrypt'
+
+_lock = threading.Lock()
+_local = threading.local()
+_finished = []
+_exporters = []
+_trace = {'trace_id': None, 'parent_id': None}
+
+
+class Span:
+    """ A timed piece of work, part of the trace of one renewal """
+
+    def __init__(self, name, trace_id, parent_id=None, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.attributes = dict(attributes or {})
+        self.status = 'ok'
+        self.start = time.time()
+        self.end = None
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def finish(self, status=None):
+        """ Ends the span(once), it's exported on the next flush() """
+        if self.end is not None:
+            return
+        self.end = time.time()
+        if status is not None:
+            self.status = status
+        if _exporters:
+            with _lock:
+                _finished.append(self)
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'start': self.start,
+            'end': self.end,
+            'duration_ms': int(((self.end or time.time()) - self.start) * 1000),
+            'status': self.status,
+            'attributes': self.attributes,
+        }
+
+
+class JsonlExporter:
+    """ Appends each span as a line of JSON to a file, or to stdout(which ends
+    up in the CloudWatch log) when path is '-' """
+
+    def __init__(self, path='-'):
+        self.path = path
+
+    def export(self, spans):
+        lines = "".join(json.dumps(span.to_dict()) + "\n" for span in spans)
+        if self.path == '-':
+            print(lines, end='')
+            return
+        with open(self.path, 'a') as f:
+            f.write(lines)
+
+
+class OtlpExporter:
+    """ Sends spans to an OpenTelemetry collector, using OTLP's JSON encoding
+    over HTTP(so no extra dependencies are needed) """
+
+    def __init__(self, endpoint, headers=None, timeout=5):
+        self.url = endpoint.rstrip('/') + '/v1/traces'
+        self.headers = dict(headers or {})
+        self.headers['Content-Type'] = 'application/json'
+        self.timeout = timeout
+
+    @staticmethod
+    def _attributes(attributes):
+        ret = []
+        for key, value in sorted(attributes.items()):
+            if isinstance(value, bool):
+                ret.append({'key': key, 'value': {'boolValue': value}})
+            elif isinstance(value, int):
+                ret.append({'key': key, 'value': {'intValue': str(value)}})
+            elif isinstance(value, float):
+                ret.append({'key': key, 'value': {'doubleValue': value}})
+            else:
+                ret.append({'key': key, 'value': {'stringValue': str(value)}})
+        return ret
+
+    def document(self, spans):
+        otlp_spans = []
+        for span in spans:
+            otlp_span = {
+                'traceId': span.trace_id,
+                'spanId': span.span_id,
+                'name': span.name,
+                'kind': 1,
+                'startTimeUnixNano': str(int(span.start * 1e9)),
+                'endTimeUnixNano': str(int(span.end * 1e9)),
+                'attributes': self._attributes(span.attributes),
+                'status': {'code': 2 if span.status == 'error' else 1},
+            }
+            if span.parent_id:
+                otlp_span['parentSpanId'] = span.parent_id
+            otlp_spans.append(otlp_span)
+        return {
+            'resourceSpans': [{
+                'resource': {'attributes': self._attributes({'service.name': SERVICE_NAME})},
+                'scopeSpans': [{'scope': {'name': SERVICE_NAME}, 'spans': otlp_spans}],
+            }]
+        }
+
+    def export(self, spans):
+        data = json.dumps(self.document(spans)).encode('utf-8')
+        urlopen(Request(self.url, data=data, headers=self.headers), timeout=self.timeout).read()
+
+
+EXPORTERS = {
+    'jsonl': JsonlExporter,
+    'otlp': OtlpExporter,
+}
+
+
+def exporters_from_config(settings):
+    """ Exporters from a list of dicts like {'type': 'jsonl', 'path': '-'} """
+    exporters = []
+    for setting in settings or []:
+        setting = dict(setting)
+        kind = setting.pop('type')
+        if kind not in EXPORTERS:
+            raise ValueError("Unknown trace exporter '{}'".format(kind))
+        exporters.append(EXPORTERS[kind](**setting))
+    return exporters
+
+
+def configure(exporters):
+    global _exporters
+    _exporters = list(exporters)
+
+
+def reset(trace=None):
+    """ Starts a new trace, or carries on one started by another invocation
+    (trace being what context() returned there) """
+    trace = trace or {}
+    _trace['trace_id'] = trace.get('trace_id') or uuid.uuid4().hex
+    _trace['parent_id'] = trace.get('parent_id')
+    _local.stack = []
+    with _lock:
+        del _finished[:]
+
+
+def snapshot():
+    """ The current trace, open spans and finished spans, for restore() """
+    with _lock:
+        return {'trace': dict(_trace), 'stack': list(_stack()), 'finished': list(_finished)}
+
+
+def restore(saved):
+    _trace.update(saved['trace'])
+    _local.stack = list(saved['stack'])
+    with _lock:
+        _finished[:] = saved['finished']
+
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def current():
+    stack = _stack()
+    return stack[-1] if stack else None
+
+
+def context():
+    """ What another invocation needs to continue this trace """
+    parent = current()
+    return {
+        'trace_id': _trace['trace_id'],
+        'parent_id': parent.span_id if parent else _trace['parent_id'],
+    }
+
+
+def start(name, **attributes):
+    """ Starts a span under the current one without making it current, for
+    work that's started and finished in different places(e.g. hooks) """
+    if _trace['trace_id'] is None:
+        reset()
+    parent = current()
+    return Span(name, _trace['trace_id'], parent.span_id if parent else _trace['parent_id'], attributes)
+
+
+@contextmanager
+def span(name, **attributes):
+    """ A span for the with block, spans started inside it are its children """
+    s = start(name, **attributes)
+    _stack().append(s)
+    try:
+        yield s
+    except Exception as e:
+        s.set('error', str(e))
+        s.status = 'error'
+        raise
+    finally:
+        _stack().pop()
+        s.finish()
+
+
+def traced(name, **attributes):
+    """ Decorator version of span() """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name, **attributes):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def flush():
+    """ Sends the finished spans to the exporters """
+    with _lock:
+        spans = list(_finished)
+        del _finished[:]
+    if not spans:
+        return
+    for exporter in _exporters:
+        try:
+            exporter.export(spans)
+        except Exception as e:
+            logger.error("Unable to export {} trace spans with {}: {}".format(
+                len(spans), exporter.__class__.__name__, e))
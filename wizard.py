@@ -9,11 +9,20 @@ Usage:
   wizard.py (-h | --help)
   wizard.py --version
   wizard.py --update-lambda
+  wizard.py --profiles [--bucket=<bucket>]
+  wizard.py --profile=<run_id> [--bucket=<bucket>] [--sort=<key>] [--limit=<n>]
+  wizard.py --profile-diff <run_a> <run_b> [--bucket=<bucket>] [--limit=<n>]
 
 Options:
     -h --help         Show this screen
     --version         Show the version
     --update-lambda   Bundle zip from existing config and upload to lambda
+    --profiles        List the profiled runs saved in the config bucket
+    --profile=<run_id>  Show where a profiled run spent its time
+    --profile-diff    Compare where two profiled runs spent their time
+    --bucket=<bucket>   The config bucket(asks if not given)
+    --sort=<key>      pstats sort order [default: cumulative]
+    --limit=<n>       Number of functions to show [default: 25]
 """
 from __future__ import print_function
 import os
@@ -22,10 +31,14 @@ import time
 import zipfile
 from docopt import docopt
 from string import Template
-from installer import terminal, ec2, sns, cloudfront, iam, s3, awslambda, elb, route53, cloud_watch_events
+from installer import terminal, ec2, sns, cloudfront, iam, s3, awslambda, elb, route53, cloud_watch_events, stepfunctions
+import instrumentation
+import model
+import profiling
 
 acme_challenge_file_name = 'simple_acme.py'
 lambda_file_name = 'lambda_function.py'
+lambda_module_file_names = ['preflight.py', 'timebudget.py', 'pipeline.py', 'fanout.py', 'scheduling.py', 'renewal.py', 'retry.py', 'metrics.py', 'instrumentation.py', 'profiling.py', 'tracing.py', 'manifest.py', 'registry.py', 'model.py', 'packing.py', 'zones.py', 'notify.py']
 zip_file_name = 'lambda-letsencrypt-dist.zip'
 config_file_template_name = 'config.py.dist'
 generated_config_file_name = 'config-wizard.py'
@@ -109,10 +122,14 @@ def wizard_elb(global_config):
         if lb is None:
             break
 
-        lb_port = terminal.get_input("What port number will this certificate be for(HTTPS is 443) [443]?",
+        lb_port = terminal.get_input("What port number(s) will this certificate be for, comma separated(HTTPS is 443) [443]?",
                                      allow_empty=True)
         if len(lb_port) == 0:
             lb_port = 443
+        else:
+            lb_port = [int(p) for p in lb_port.split(',') if p.strip()]
+            if len(lb_port) == 1:
+                lb_port = lb_port[0]
 
         domains = []
         while True:
@@ -139,6 +156,10 @@ def wizard_elb(global_config):
             'ELB_PORT': lb_port,
             'DOMAINS': domains,
         }
+        if terminal.get_yn("Add this certificate alongside the listener's default one(SNI, for sharing the ELB between sites)", default=False):
+            site['ELB_SNI'] = True
+        if terminal.get_yn("Store this certificate in ACM(instead of IAM)", default=False):
+            site['CERT_BACKEND'] = 'acm'
         global_config['elb_sites'].append(site)
 
 
@@ -183,7 +204,12 @@ def wizard_cf(global_config):
             Each domain in this list will be validated with Lets-Encrypt and added to the certificate assigned to this
             Distribution.""")
         print()
+        names = []
         for dns_name in cnames:
+            if model.is_wildcard(dns_name):
+                # Lets-Encrypt's ACME v1 API(see simple_acme.py) never issued wildcards
+                terminal.write_str("Wildcards can't be issued, skipping '{}'".format(dns_name))
+                continue
             domain = {
                 'DOMAIN': dns_name,
                 'VALIDATION_METHODS': []
@@ -208,10 +234,15 @@ def wizard_cf(global_config):
                 domain['VALIDATION_METHODS'].append('http-01')
 
             global_config['cf_domains'].append(domain)
+            names.append(dns_name)
+        if not names:
+            continue
         site = {
             'CLOUDFRONT_ID': dist['Id'],
-            'DOMAINS': cnames
+            'DOMAINS': names
         }
+        if terminal.get_yn("Store this certificate in ACM(instead of IAM)", default=False):
+            site['CERT_BACKEND'] = 'acm'
         global_config['cf_sites'].append(site)
 
 
@@ -360,6 +391,15 @@ def wizard_trigger(global_config):
     print()
     create_cloudwatch_rule = terminal.get_yn("Set up AWS Lambda trigger?", default=True)
     global_config['create_cloudwatch_rule'] = create_cloudwatch_rule
+    print()
+    terminal.write_str("""\
+        Instead of invoking the function directly, the trigger can start a Step
+        Functions state machine that runs each step(planning, authorization,
+        waiting for validation, issuing and deploying) separately. Waiting for
+        Lets-Encrypt to validate your domains then happens in the state machine
+        instead of over several daily runs.""")
+    use_state_machine = terminal.get_yn("Use a Step Functions state machine?", default=False)
+    global_config['use_state_machine'] = use_state_machine
 
 
 def wizard_summary(global_config):
@@ -396,13 +436,15 @@ def wizard_summary(global_config):
 
     print("CloudFront Distributions To Manage:")
     for cf in gc['cf_sites']:
-        print("    {} - [{}]".format(cf['CLOUDFRONT_ID'], ",".join(cf['DOMAINS'])))
+        print("    {} - [{}] ({})".format(cf['CLOUDFRONT_ID'], ",".join(cf['DOMAINS']), cf.get('CERT_BACKEND', 'iam')))
 
     print("Elastic Load Balancers to Manage:")
     for lb in gc['elb_sites']:
-        print("    {}:{} - [{}]".format(lb['ELB_NAME'], lb['ELB_PORT'], ",".join(lb['DOMAINS'])))
+        print("    {}:{} - [{}] ({}{})".format(lb['ELB_NAME'], lb['ELB_PORT'], ",".join(lb['DOMAINS']), lb.get('CERT_BACKEND', 'iam'),
+                                           ", SNI" if lb.get('ELB_SNI') else ""))
 
     print("Create daily Lambda function trigger:            {}".format(gc['create_cloudwatch_rule']))
+    print("Use Step Functions state machine:                {}".format(gc['use_state_machine']))
 
 
 def wizard_save_config(global_config):
@@ -458,6 +500,12 @@ def wizard_save_config(global_config):
         print("Still waiting...")
         time.sleep(5)
 
+    # the function moves its own trigger to whenever it next has work to do
+    templatevars['SCHEDULE_RULE_NAME'] = None
+    if global_config['create_cloudwatch_rule'] and not global_config['use_state_machine']:
+        templatevars['SCHEDULE_RULE_NAME'] = "daily-event-for-lambda-letsencrypt-{}".format(global_config['namespace'])
+    templatevars['SCHEDULE_RULE_NAME'] = repr(templatevars['SCHEDULE_RULE_NAME'])
+
     templatevars['S3_CONFIG_BUCKET'] = global_config['s3_cfg_bucket']
     templatevars['S3_CHALLENGE_BUCKET'] = global_config['s3_challenge_bucket']
 
@@ -488,10 +536,26 @@ def wizard_save_config(global_config):
         print(terminal.Colors.FAIL + u'\u2717' + terminal.Colors.ENDC)
         return
 
+    state_machine_arn = None
+    if global_config['use_state_machine']:
+        print("    Creating Step Functions state machine ", end='')
+        state_machine_name = "lambda-letsencrypt-{}".format(global_config['namespace'])
+        definition = stepfunctions.generate_definition(lambda_function['FunctionArn'])
+        state_machine_arn = stepfunctions.create_or_update_state_machine(state_machine_name, definition, iam_arn)
+        if state_machine_arn:
+            print(terminal.Colors.OKGREEN + u'\u2713' + terminal.Colors.ENDC)
+        else:
+            print(terminal.Colors.FAIL + u'\u2717' + terminal.Colors.ENDC)
+            return
+
     if global_config['create_cloudwatch_rule']:
         print("    Setting daily Lambda function trigger ", end='')
-        lambda_execution_rule = cloud_watch_events.cloudwatch_create_daily_rule_for_function(
-            lambda_function['FunctionName'], lambda_function['FunctionArn'], iam_arn)
+        if state_machine_arn:
+            lambda_execution_rule = cloud_watch_events.cloudwatch_create_daily_rule_for_state_machine(
+                state_machine_name, state_machine_arn, iam_arn)
+        else:
+            lambda_execution_rule = cloud_watch_events.cloudwatch_create_daily_rule_for_function(
+                lambda_function['FunctionName'], lambda_function['FunctionArn'], iam_arn)
         if lambda_execution_rule:
             print(terminal.Colors.OKGREEN + u'\u2713' + terminal.Colors.ENDC)
         else:
@@ -533,7 +597,7 @@ def create_lambda_zip():
     archive_success = True
     archive = zipfile.ZipFile(zip_file_name, mode='w')
     try:
-        for f in [lambda_file_name, acme_challenge_file_name]:
+        for f in [lambda_file_name, acme_challenge_file_name] + lambda_module_file_names:
             print("    Adding '{}'".format(f))
             archive.write(f)
         print("    Adding '{}'".format(config_file_name))
@@ -562,7 +626,36 @@ def update_lambda():
         print(terminal.Colors.OKGREEN + u'\u2713' + terminal.Colors.ENDC)
     else:
         print(terminal.Colors.FAIL + u'\u2717' + terminal.Colors.ENDC)
-        return
+    print_aws_operations()
+
+
+def print_aws_operations():
+    # the AWS calls the installer made(see installer/*.py), slowest first
+    rows = instrumentation.table()
+    if rows:
+        terminal.print_header("AWS calls")
+        print(instrumentation.format_table(rows))
+
+
+def profile_key(run_id):
+    return "{}/{}.prof".format(profiling.PROFILE_DIR, run_id)
+
+
+def list_profiles(bucket):
+    terminal.print_header("Profiled runs")
+    for key, modified in sorted(s3.list_keys(bucket, profiling.PROFILE_DIR + '/'), key=lambda k: k[1]):
+        print("    {}  {}".format(modified.strftime("%Y-%m-%d %H:%M:%S"), key[len(profiling.PROFILE_DIR) + 1:-len('.prof')]))
+
+
+def show_profile(bucket, run_id, sort, limit):
+    terminal.print_header("Profile of run {}".format(run_id))
+    print(profiling.summarize(s3.get_object(bucket, profile_key(run_id)), sort=sort, limit=limit))
+
+
+def diff_profiles(bucket, run_a, run_b, limit):
+    terminal.print_header("Profile of run {}(a) compared to {}(b)".format(run_a, run_b))
+    print(profiling.diff(s3.get_object(bucket, profile_key(run_a)), s3.get_object(bucket, profile_key(run_b)),
+                         limit=limit))
 
 
 def wizard():
@@ -628,12 +721,21 @@ def wizard():
                 selection(global_config)
 
     wizard_save_config(global_config)
+    print_aws_operations()
 
 
 if __name__ == "__main__":
     args = docopt(__doc__, version='Lambda Lets-Encrypt 1.0')
     if args['--update-lambda']:
         update_lambda()
+    elif args['--profiles'] or args['--profile'] or args['--profile-diff']:
+        bucket = args['--bucket'] or choose_s3_bucket()
+        if args['--profiles']:
+            list_profiles(bucket)
+        elif args['--profile']:
+            show_profile(bucket, args['--profile'], args['--sort'], int(args['--limit']))
+        else:
+            diff_profiles(bucket, args['<run_a>'], args['<run_b>'], int(args['--limit']))
     else:
         wizard()
 
@@ -0,0 +1,135 @@
+from __future__ import print_function
+import json
+import logging
+import time
+
+import retry
+
+logger = logging.getLogger("Lambda-LetsEncrypt")
+
+# Where the list of hosted zones is cached in the config bucket, and for how
+# long(seconds)
+CACHE_KEY = 'letsencrypt/route53-zones.json'
+CACHE_SECONDS = 3600
+# A name with no zone lists the zones again, if the list is at least this old
+REFRESH_ON_MISS_SECONDS = 300
+
+
+def labels(name):
+    # 'www.example.com.' -> ['com', 'example', 'www'], a wildcard's zone is
+    # the one for the name under it
+    name = name.lower().rstrip('.')
+    if name.startswith('*.'):
+        name = name[2:]
+    return list(reversed(name.split('.')))
+
+
+def list_zones(client):
+    """ Every hosted zone as {'Id', 'Name'(without the trailing dot),
+    'Private'}, paging through list_hosted_zones """
+    zones = []
+    args = {}
+    while True:
+        resp = client.list_hosted_zones(**args)
+        for zone in resp['HostedZones']:
+            zones.append({
+                'Id': zone['Id'],
+                'Name': zone['Name'].rstrip('.'),
+                'Private': zone.get('Config', {}).get('PrivateZone', False),
+            })
+        if not resp.get('IsTruncated'):
+            return zones
+        args['Marker'] = resp['NextMarker']
+
+
+class ZoneIndex:
+    """ Hosted zones in a trie of their reversed labels(com -> example -> www),
+    so the zone for a name is found by walking its labels and keeping the
+    deepest zone on the way, however many zones there are.
+
+    Lets-Encrypt checks dns-01 challenges in public DNS, where private zones
+    aren't visible, so a public zone always wins over a private one and private
+    zones are only used when asked for. """
+
+    def __init__(self, zones):
+        # each node is {label: child node}, with the zones ending there under None
+        self.root = {}
+        for zone in zones:
+            self.add(zone)
+
+    def add(self, zone):
+        node = self.root
+        for label in labels(zone['Name']):
+            node = node.setdefault(label, {})
+        kind = 'private' if zone['Private'] else 'public'
+        found = node.setdefault(None, {})
+        if kind in found:
+            logger.warning("More than one {} hosted zone for {}, using {}".format(kind, zone['Name'], found[kind]))
+            return
+        found[kind] = zone['Id']
+
+    def lookup(self, name, include_private=False):
+        """ Id of the zone that's the longest suffix of name, or None """
+        node = self.root
+        zone_id = None
+        for label in labels(name):
+            node = node.get(label)
+            if node is None:
+                break
+            found = node.get(None)
+            if found:
+                zone_id = found.get('public') or (found.get('private') if include_private else None) or zone_id
+        return zone_id
+
+
+class ZoneResolver:
+    """ Finds the hosted zone for dns-01 domains without a ROUTE53_ZONE_ID.
+    The zones are listed once and the list cached in the config bucket for ttl
+    seconds, so thousands of domains cost one(paged) API call and later runs
+    don't need any. """
+
+    def __init__(self, route53, s3_client, bucket, key=CACHE_KEY, ttl=CACHE_SECONDS):
+        self.route53 = route53
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.ttl = ttl
+        self.index = None
+        self.listed_at = 0
+
+    def zone_for(self, name):
+        if self.index is None or time.time() - self.listed_at > self.ttl:
+            self.load()
+        zone_id = self.index.lookup(name)
+        if zone_id is None and time.time() - self.listed_at > REFRESH_ON_MISS_SECONDS:
+            # the zone may be newer than our list
+            self.refresh()
+            zone_id = self.index.lookup(name)
+        return zone_id
+
+    def load(self):
+        cached = self.read_cache()
+        if cached is not None and time.time() - cached['listed_at'] <= self.ttl:
+            self.index = ZoneIndex(cached['zones'])
+            self.listed_at = cached['listed_at']
+        else:
+            self.refresh()
+
+    def refresh(self):
+        zones = list_zones(self.route53)
+        self.index = ZoneIndex(zones)
+        self.listed_at = time.time()
+        logger.info("Listed {} Route53 hosted zones".format(len(zones)))
+        self.s3_client.put_object(
+            Bucket=self.bucket, Key=self.key, ContentType='application/json',
+            Body=json.dumps({'listed_at': self.listed_at, 'zones': zones}).encode('utf-8')
+        )
+
+    def read_cache(self):
+        try:
+            obj = self.s3_client.get_object(Bucket=self.bucket, Key=self.key)
+        except Exception as e:
+            if retry.error_code(e) not in ('NoSuchKey', '404'):
+                raise
+            return None
+        return json.loads(obj['Body'].read().decode('utf-8'))